@@ -0,0 +1,203 @@
+# Generation admission: how many replies this worker generates at once, and
+# who goes next when it is full.
+#
+# At most GEN_MAX_CONCURRENCY provider generations run per worker. The last
+# GEN_PRIORITY_RESERVED of those slots are kept for the priority lane:
+# sessions that hit the crisis check within the last CRISIS_PRIORITY_WINDOW_S
+# (shared through Redis when REDIS_URL is set, so any worker honours it).
+# Priority turns skip the normal queue and may use any free slot.
+#
+# Everyone else waits in one FIFO per user (main's _user_key: the session
+# until there is an authenticated user id), and freed slots go round-robin
+# across users with someone waiting, so one busy user gets one turn in line
+# like everybody else. A turn that waits longer
+# than GEN_QUEUE_TIMEOUT_S (or past its request's deadline) gets
+# SlotWaitTimeout.
+#
+# Crisis messages themselves never reach this: main answers them before
+# taking the session turn.
+
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from deadline import budget
+from metrics import counter, gauge, histogram
+from redis_client import get_redis
+
+GEN_MAX_CONCURRENCY = int(os.getenv("GEN_MAX_CONCURRENCY", "64"))  # 0 = unlimited
+GEN_PRIORITY_RESERVED = int(os.getenv("GEN_PRIORITY_RESERVED", "4"))
+GEN_QUEUE_TIMEOUT_S = float(os.getenv("GEN_QUEUE_TIMEOUT_S", "30"))
+CRISIS_PRIORITY_WINDOW_S = int(os.getenv("CRISIS_PRIORITY_WINDOW_S", "3600"))
+
+SLOTS_ACTIVE = gauge("generation_slots_active", "Provider generations running in this worker")
+QUEUED = gauge("generation_queue_depth", "Turns waiting for a generation slot, by lane")
+QUEUE_WAIT = histogram("generation_queue_wait_seconds", "Time spent waiting for a generation slot, by lane")
+QUEUE_TIMEOUTS = counter("generation_queue_timeouts_total", "Turns that gave up waiting for a slot, by lane")
+
+
+class SlotWaitTimeout(Exception):
+    """No generation slot became free within GEN_QUEUE_TIMEOUT_S."""
+
+
+class _Gate:
+    def __init__(self, limit: int, reserved: int):
+        self.limit = limit
+        # leave at least one slot for the normal lane
+        self.reserved = max(0, min(reserved, limit - 1)) if limit > 0 else 0
+        self.active = 0
+        self._priority = deque()
+        self._users = OrderedDict()  # user_key -> deque of waiters; no empty deques
+        self._normal_waiting = 0
+
+    def _free(self, priority: bool) -> bool:
+        if self.limit <= 0:
+            return True
+        return self.active < (self.limit if priority else self.limit - self.reserved)
+
+    async def acquire(self, user_key: str, priority: bool, timeout: float):
+        if priority:
+            if not self._priority and self._free(True):
+                self._admit()
+                return
+        elif not self._normal_waiting and self._free(False):
+            self._admit()
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        if priority:
+            self._priority.append(fut)
+        else:
+            self._users.setdefault(user_key, deque()).append(fut)
+            self._normal_waiting += 1
+        self._update_queued()
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # granted just as we gave up: hand the slot on
+                self.release()
+            else:
+                self._forget(fut, user_key, priority)
+            raise
+
+    def _admit(self):
+        self.active += 1
+        SLOTS_ACTIVE.set(self.active)
+
+    def release(self):
+        self.active -= 1
+        SLOTS_ACTIVE.set(self.active)
+        while True:
+            fut = self._next()
+            if fut is None:
+                break
+            self._admit()
+            fut.set_result(None)
+        self._update_queued()
+
+    def _next(self):
+        if self._priority and self._free(True):
+            return self._priority.popleft()
+        if self._users and self._free(False):
+            user_key, waiters = next(iter(self._users.items()))
+            fut = waiters.popleft()
+            self._normal_waiting -= 1
+            if waiters:
+                self._users.move_to_end(user_key)  # next user's turn
+            else:
+                del self._users[user_key]
+            return fut
+        return None
+
+    def _forget(self, fut, user_key: str, priority: bool):
+        if priority:
+            self._priority.remove(fut)
+        else:
+            waiters = self._users[user_key]
+            waiters.remove(fut)
+            self._normal_waiting -= 1
+            if not waiters:
+                del self._users[user_key]
+        self._update_queued()
+
+    def _update_queued(self):
+        QUEUED.set(len(self._priority), lane="priority")
+        QUEUED.set(self._normal_waiting, lane="normal")
+
+
+_gate = _Gate(GEN_MAX_CONCURRENCY, GEN_PRIORITY_RESERVED)
+_redis = get_redis()
+# session_id -> monotonic deadline (this worker's view). Every mark gets the
+# same window and is re-inserted at the end, so the dict is ordered by
+# deadline and expired entries are always at the front.
+_priority_until = {}
+
+
+def _priority_key(session_id: str) -> str:
+    return f"skylar:priority:{session_id}"
+
+
+def mark_priority(session_id: str):
+    """Put the session in the priority lane for CRISIS_PRIORITY_WINDOW_S."""
+    now = time.monotonic()
+    _prune_priority(now)
+    _priority_until.pop(session_id, None)
+    _priority_until[session_id] = now + CRISIS_PRIORITY_WINDOW_S
+    if _redis is not None:
+        try:
+            _redis.set(_priority_key(session_id), "1", ex=CRISIS_PRIORITY_WINDOW_S)
+        except Exception:
+            pass  # this worker still knows
+
+
+def _prune_priority(now: float):
+    while _priority_until:
+        session_id, until = next(iter(_priority_until.items()))
+        if until > now:
+            break
+        del _priority_until[session_id]
+
+
+def is_priority(session_id: str) -> bool:
+    until = _priority_until.get(session_id)
+    if until is not None:
+        if until > time.monotonic():
+            return True
+        del _priority_until[session_id]
+    if _redis is not None:
+        try:
+            return bool(_redis.exists(_priority_key(session_id)))
+        except Exception:
+            return False
+    return False
+
+
+def queue_depth() -> int:
+    """Turns waiting for a generation slot in this worker (both lanes)."""
+    return len(_gate._priority) + _gate._normal_waiting
+
+
+@asynccontextmanager
+async def generation_slot(session_id: str, user_key: str):
+    """
+    Hold one of this worker's generation slots for the duration of the block.
+
+    Raises SlotWaitTimeout if none frees up within GEN_QUEUE_TIMEOUT_S or
+    the request's remaining time.
+    """
+    priority = is_priority(session_id)
+    lane = "priority" if priority else "normal"
+    started = time.perf_counter()
+    try:
+        await _gate.acquire(user_key, priority, max(0.0, budget(GEN_QUEUE_TIMEOUT_S)))
+    except asyncio.TimeoutError:
+        QUEUE_TIMEOUTS.inc(lane=lane)
+        raise SlotWaitTimeout(session_id)
+    QUEUE_WAIT.observe(time.perf_counter() - started, lane=lane)
+    try:
+        yield priority
+    finally:
+        _gate.release()
@@ -0,0 +1,104 @@
+# Requests per second through serve.py at several worker counts.
+#
+#     python bench/serve_rps.py [--workers 1,2,4,8] [--seconds 5] [--connections 32]
+#
+# For each count, starts `python serve.py` with WEB_CONCURRENCY set to it,
+# waits until the port answers, then drives GET /health (no provider, no
+# session store) over keep-alive connections from one asyncio client and
+# prints the rate. Run it on the host you size for: on a machine with fewer
+# cores than workers (the client needs one too), extra workers only add
+# contention.
+#
+# More than one worker needs a shared session store, so unless REDIS_URL is
+# set the servers get a fresh SESSION_ARENA_PATH in a temporary directory.
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def _connection(port: int, path: str, stop: float, counts: list):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode()
+    done = 0
+    try:
+        while time.perf_counter() < stop:
+            writer.write(request)
+            await writer.drain()
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            done += 1
+    finally:
+        counts.append(done)
+        writer.close()
+
+
+async def _load(port: int, path: str, seconds: float, connections: int) -> float:
+    counts = []
+    stop = time.perf_counter() + seconds
+    await asyncio.gather(*(_connection(port, path, stop, counts) for _ in range(connections)))
+    return sum(counts) / seconds
+
+
+def _wait_for_port(port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"serve.py did not open port {port} within {timeout:.0f}s")
+
+
+def run(workers: int, port: int, args, scratch: str) -> float:
+    env = dict(
+        os.environ,
+        HOST="127.0.0.1",
+        PORT=str(port),
+        WEB_CONCURRENCY=str(workers),
+    )
+    env.setdefault("GEMINI_API_KEY", "bench")
+    if not env.get("REDIS_URL"):
+        env["SESSION_ARENA_PATH"] = os.path.join(scratch, f"arena-{workers}")
+    server = subprocess.Popen([sys.executable, "serve.py"], cwd=BACKEND, env=env)
+    try:
+        _wait_for_port(port, 60)
+        time.sleep(args.warmup)  # let every worker finish importing the app
+        return asyncio.run(_load(port, args.path, args.seconds, args.connections))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Requests per second through serve.py.")
+    parser.add_argument("--workers", default="1,2,4,8", help="comma-separated counts")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds after the port opens")
+    parser.add_argument("--path", default="/health")
+    parser.add_argument("--port", type=int, default=18800)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs, {args.connections} connections, {args.seconds:.0f}s per run")
+    with tempfile.TemporaryDirectory(prefix="skylar-bench-") as scratch:
+        for i, workers in enumerate(int(w) for w in args.workers.split(",")):
+            rps = run(workers, args.port + i, args, scratch)
+            print(f"workers={workers:<3d} {rps:8.0f} req/s", flush=True)
+
+
+if __name__ == "__main__":
+    main()
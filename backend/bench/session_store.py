@@ -0,0 +1,137 @@
+# Session store latency: in-memory dict vs. shared-memory arena vs. Redis.
+#
+#     python bench/session_store.py [--ops 20000] [--sessions 1000] [--procs 2]
+#     REDIS_URL=redis://localhost:6379/0 python bench/session_store.py
+#
+# Times get_meta, append and history (HISTORY_LIMIT items) on each store,
+# per call, over --sessions sessions with chat-sized messages. The shared
+# stores (arena, and Redis when REDIS_URL is set) are also run from --procs
+# processes at once, as serve.py's workers would use them. The arena file
+# goes to a temporary directory on /dev/shm when there is one, with room for
+# every benchmark session at a quarter of its slots (SESSION_ARENA_SLOT_KB
+# applies).
+#
+# Benchmark sessions are named "bench-..."; they are deleted from Redis
+# afterwards.
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis_client  # noqa: E402
+
+MESSAGE = "I had a long day and I just want to talk about it for a bit. " * 3
+META = {"user_name": "Ana", "companion_name": "Luna", "style": "warm", "user_external_id": None}
+
+
+def _session_ids(tag: str, sessions: int):
+    return [f"bench-{tag}-{i:08d}" for i in range(sessions)]
+
+
+def measure(store, tag: str, ops: int, sessions: int) -> dict:
+    sids = _session_ids(tag, sessions)
+    for sid in sids:
+        store.save_meta(sid, META)
+    timings = {}
+
+    started = time.perf_counter()
+    for i in range(ops):
+        store.get_meta(sids[i % sessions])
+    timings["get_meta"] = (time.perf_counter() - started) / ops
+
+    started = time.perf_counter()
+    for i in range(ops):
+        store.append(sids[i % sessions], "user", MESSAGE)
+    timings["append"] = (time.perf_counter() - started) / ops
+
+    reads = max(1, ops // 4)
+    started = time.perf_counter()
+    for i in range(reads):
+        store.history(sids[i % sessions])
+    timings["history"] = (time.perf_counter() - started) / reads
+    return timings
+
+
+def _open(kind: str, arena):
+    if kind == "redis":
+        return redis_client._RedisStore(os.environ["REDIS_URL"])
+    if kind == "arena":
+        path, slots = arena
+        return redis_client._ArenaStore(path, slots, redis_client.SESSION_ARENA_SLOT_KB * 1024)
+    return redis_client._MemoryStore()
+
+
+def _worker(kind: str, arena, tag: str, ops: int, sessions: int, results):
+    results.put(measure(_open(kind, arena), tag, ops, sessions))
+
+
+def measure_parallel(kind: str, arena, procs: int, ops: int, sessions: int) -> dict:
+    """Per-call timings averaged over `procs` processes running at once."""
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=_worker, args=(kind, arena, f"p{i}", ops, sessions, results)
+        )
+        for i in range(procs)
+    ]
+    for worker in workers:
+        worker.start()
+    each = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return {op: sum(r[op] for r in each) / procs for op in each[0]}
+
+
+def _cleanup_redis(tags, sessions: int):
+    store = redis_client._RedisStore(os.environ["REDIS_URL"])
+    for tag in tags:
+        sids = _session_ids(tag, sessions)
+        pipe = store.client.pipeline(transaction=False)
+        for sid in sids:
+            pipe.delete(*(store._key(sid, kind) for kind in ("meta", "history", "seq")))
+        pipe.zrem(store._ACTIVE_KEY, *sids)
+        pipe.execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session store latency per call.")
+    parser.add_argument("--ops", type=int, default=20000, help="get_meta/append calls per run")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--procs", type=int, default=2, help="processes for the shared-store runs")
+    args = parser.parse_args()
+
+    shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    scratch = tempfile.mkdtemp(prefix="skylar-bench-", dir=shm)
+    arena_path = os.path.join(scratch, "arena")
+    arena = (arena_path, 4 * args.sessions * (1 + args.procs))
+    kinds = ["dict", "arena"] + (["redis"] if os.getenv("REDIS_URL") else [])
+    rows = []
+    try:
+        for kind in kinds:
+            rows.append((kind, measure(_open(kind, arena), "single", args.ops, args.sessions)))
+            if kind != "dict" and args.procs > 1:
+                rows.append((
+                    f"{kind} x{args.procs} procs",
+                    measure_parallel(kind, arena, args.procs, args.ops, args.sessions),
+                ))
+    finally:
+        if os.path.exists(arena_path):
+            os.remove(arena_path)
+        os.rmdir(scratch)
+        if "redis" in kinds:
+            _cleanup_redis(["single"] + [f"p{i}" for i in range(args.procs)], args.sessions)
+
+    print(f"{os.cpu_count()} CPUs, {args.ops} ops over {args.sessions} sessions, per call:")
+    if "redis" not in kinds:
+        print("(set REDIS_URL to include the Redis store)")
+    for name, timings in rows:
+        print(f"  {name:20s}" + "".join(f"  {op} {t * 1e6:7.1f} us" for op, t in timings.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,94 @@
 import os
+import time
 import uuid
 from typing import Optional
-from datetime import datetime 
+from datetime import date, datetime
 
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column
-from sqlalchemy import String, DateTime, func, select
+from sqlalchemy import String, Integer, Float, Text, Date, DateTime, func, select, inspect, text, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from metrics import counter, gauge, histogram
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Connection pool settings (ignored for in-memory SQLite, which has no pool).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_S = float(os.getenv("DB_POOL_TIMEOUT_S", "5"))
+DB_POOL_RECYCLE_S = int(os.getenv("DB_POOL_RECYCLE_S", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+
+POOL_WAIT = histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled DB connection",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+POOL_IN_USE = gauge("db_pool_in_use", "DB connections currently checked out")
+POOL_OVERFLOW = counter(
+    "db_pool_overflow_total",
+    "Checkouts that needed a connection beyond DB_POOL_SIZE",
+)
+POOL_TIMEOUTS = counter("db_pool_timeouts_total", "Checkouts that hit DB_POOL_TIMEOUT_S")
+
+
+class _InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started)
+
+
+def _engine_options(url: str) -> dict:
+    if make_url(url).database in (None, "", ":memory:"):
+        return {}
+    return dict(
+        poolclass=_InstrumentedPool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT_S,
+        pool_recycle=DB_POOL_RECYCLE_S,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+def _instrument(engine) -> None:
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, _InstrumentedPool):
+        return
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def _on_checkout(dbapi_connection, record, proxy):
+        in_use = pool.checkedout()
+        POOL_IN_USE.set(in_use)
+        if in_use > pool.size():
+            POOL_OVERFLOW.inc()
+
+    @event.listens_for(engine.sync_engine, "checkin")
+    def _on_checkin(dbapi_connection, record):
+        POOL_IN_USE.set(pool.checkedout())
+
+
 Base = declarative_base()
 engine = None
 AsyncSessionLocal = None
 
 if DATABASE_URL:
-    engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+    engine = create_async_engine(
+        DATABASE_URL, echo=False, future=True, **_engine_options(DATABASE_URL)
+    )
+    _instrument(engine)
     AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 
 
@@ -22,7 +96,7 @@ class UserProfile(Base):
     __tablename__ = "user_profiles"
 
     id: Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
-    user_external_id: Mapped[str] = mapped_column(String(128), index=True)
+    user_external_id: Mapped[str] = mapped_column(String(128), index=True, unique=True)
     display_name: Mapped[str] = mapped_column(String(120))
     companion_name: Mapped[str] = mapped_column(String(120))
     preferred_style: Mapped[str] = mapped_column(String(40))
@@ -32,13 +106,137 @@ class UserProfile(Base):
     )
 
 
+class ChatMessage(Base):
+    """Durable conversation history, written behind the session store."""
+
+    __tablename__ = "chat_messages"
+
+    session_id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True)
+    role: Mapped[str] = mapped_column(String(16))
+    content: Mapped[str] = mapped_column(Text)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+
+class UsageDaily(Base):
+    """Provider usage per UTC day for one session, user, route or model."""
+
+    __tablename__ = "usage_daily"
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    scope: Mapped[str] = mapped_column(String(16), primary_key=True)
+    key: Mapped[str] = mapped_column(String(128), primary_key=True)
+    calls: Mapped[float] = mapped_column(Float, default=0)
+    prompt_tokens: Mapped[float] = mapped_column(Float, default=0)
+    cached_tokens: Mapped[float] = mapped_column(Float, default=0)
+    output_tokens: Mapped[float] = mapped_column(Float, default=0)
+    cost_usd: Mapped[float] = mapped_column(Float, default=0)
+
+
+# Versioned schema. Each migration runs once, in order, inside the same
+# transaction that bumps schema_version. Boot costs one SELECT when the
+# schema is current; otherwise one worker migrates under an advisory lock
+# while the others wait on it, then see the new version and skip.
+_MIGRATION_LOCK_ID = 0x536B796C  # arbitrary, shared by every worker
+
+
+def _create_user_profiles(conn) -> None:
+    # checkfirst: databases from before versioning already have the table
+    UserProfile.__table__.create(conn, checkfirst=True)
+
+
+def _ensure_unique_external_id(conn) -> None:
+    """
+    Older databases have a plain index on user_external_id (and possibly
+    duplicate rows from concurrent /start calls). Keep the oldest row per id
+    and swap the index for a unique one. No-op once migrated.
+    """
+    index_name = "ix_user_profiles_user_external_id"
+    for index in inspect(conn).get_indexes("user_profiles"):
+        if index["name"] == index_name and index["unique"]:
+            return
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(
+            "DELETE FROM user_profiles a USING user_profiles b "
+            "WHERE a.user_external_id = b.user_external_id "
+            "AND (a.created_at, a.id) > (b.created_at, b.id)"
+        ))
+    else:
+        conn.execute(text(
+            "DELETE FROM user_profiles WHERE rowid NOT IN "
+            "(SELECT MIN(rowid) FROM user_profiles GROUP BY user_external_id)"
+        ))
+    conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+    conn.execute(text(
+        f"CREATE UNIQUE INDEX {index_name} ON user_profiles (user_external_id)"
+    ))
+
+
+def _create_chat_messages(conn) -> None:
+    ChatMessage.__table__.create(conn, checkfirst=True)
+
+
+def _create_usage_daily(conn) -> None:
+    UsageDaily.__table__.create(conn, checkfirst=True)
+
+
+# Append only; never reorder or edit a shipped migration.
+MIGRATIONS = (
+    (1, _create_user_profiles),
+    (2, _ensure_unique_external_id),
+    (3, _create_chat_messages),
+    (4, _create_usage_daily),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def _schema_version(conn) -> int:
+    """Current schema version; 0 if the database has never been versioned."""
+    try:
+        row = (await conn.execute(text("SELECT version FROM schema_version"))).first()
+    except exc.DBAPIError:
+        return 0
+    return row[0] if row else 0
+
+
+def _migrate(conn, current: int) -> None:
+    for version, migration in MIGRATIONS:
+        if version > current:
+            migration(conn)
+    conn.execute(text("UPDATE schema_version SET version = :v"), {"v": SCHEMA_VERSION})
+    conn.execute(
+        text(
+            "INSERT INTO schema_version (version) SELECT :v "
+            "WHERE NOT EXISTS (SELECT 1 FROM schema_version)"
+        ),
+        {"v": SCHEMA_VERSION},
+    )
+
 
 async def init_db_if_configured():
-    """Create tables if DATABASE_URL is set. Safe to call on startup."""
+    """
+    Bring the schema up to SCHEMA_VERSION if DATABASE_URL is set. Safe to
+    call on startup from every worker: when the schema is current this is a
+    single SELECT, with no DDL or reflection.
+    """
     if engine is None:
         return
+    async with engine.connect() as conn:
+        if await _schema_version(conn) >= SCHEMA_VERSION:
+            return
+
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        if conn.dialect.name == "postgresql":
+            # held until commit; later workers queue here, then find nothing to do
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": _MIGRATION_LOCK_ID})
+        await conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+        if conn.dialect.name != "postgresql":
+            # SQLite has no advisory locks; a no-op write takes its write lock
+            await conn.execute(text("UPDATE schema_version SET version = version"))
+        current = await _schema_version(conn)
+        if current < SCHEMA_VERSION:
+            await conn.run_sync(_migrate, current)
 
 
 async def get_db() -> AsyncSession:
@@ -49,39 +247,119 @@ async def get_db() -> AsyncSession:
         yield session
 
 
-async def get_user_profile(user_external_id: str) -> Optional[UserProfile]:
-    if AsyncSessionLocal is None:
-        return None
-    async with AsyncSessionLocal() as session:
-        q = await session.execute(
-            select(UserProfile).where(UserProfile.user_external_id == user_external_id)
-        )
-        return q.scalars().first()
+def _profile_insert(values: dict):
+    """INSERT for user_profiles in the engine's dialect (ON CONFLICT support)."""
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    return insert(UserProfile).values(id=uuid.uuid4(), **values)
+
+
+_PROFILE_COLUMNS = (
+    UserProfile.display_name,
+    UserProfile.companion_name,
+    UserProfile.preferred_style,
+)
 
 
-async def upsert_user_profile(
+async def get_or_create_user_profile(
     user_external_id: str,
     display_name: str,
     companion_name: str,
     preferred_style: str,
-) -> None:
+) -> Optional[dict]:
+    """
+    Return the stored profile for this id, creating it from the given values
+    if there is none. One statement, one round trip:
+
+        INSERT ... ON CONFLICT (user_external_id)
+        DO UPDATE SET user_external_id = excluded.user_external_id
+        RETURNING display_name, companion_name, preferred_style
+
+    The no-op DO UPDATE (rather than DO NOTHING) makes RETURNING yield the
+    existing row on conflict.
+    """
+    if AsyncSessionLocal is None:
+        return None
+    stmt = _profile_insert(
+        dict(
+            user_external_id=user_external_id,
+            display_name=display_name,
+            companion_name=companion_name,
+            preferred_style=preferred_style,
+        )
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserProfile.user_external_id],
+        set_={"user_external_id": stmt.excluded.user_external_id},
+    ).returning(*_PROFILE_COLUMNS)
+
+    async with AsyncSessionLocal() as session:
+        row = (await session.execute(stmt)).one()
+        await session.commit()
+    return dict(row._mapping)
+
+
+async def insert_chat_messages(rows: list) -> None:
+    """
+    Persist a batch of history rows with a single multi-row INSERT.
+    Rows already stored (same session_id + seq) are skipped, so a retried
+    batch is harmless.
+    """
+    if AsyncSessionLocal is None or not rows:
+        return
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    stmt = insert(ChatMessage).values(rows).on_conflict_do_nothing(
+        index_elements=[ChatMessage.session_id, ChatMessage.seq]
+    )
+    async with AsyncSessionLocal() as session:
+        await session.execute(stmt)
+        await session.commit()
+
+
+async def get_chat_messages(session_id: str, before: Optional[int], limit: int) -> list:
+    """
+    Up to `limit` persisted messages with seq < `before` (newest page if
+    `before` is None), returned oldest first. Keyset on the (session_id, seq)
+    primary key, so every page costs the same regardless of history length.
+    """
     if AsyncSessionLocal is None:
+        return []
+    q = select(ChatMessage).where(ChatMessage.session_id == session_id)
+    if before is not None:
+        q = q.where(ChatMessage.seq < before)
+    q = q.order_by(ChatMessage.seq.desc()).limit(limit)
+    async with AsyncSessionLocal() as session:
+        rows = (await session.execute(q)).scalars().all()
+    return [
+        {
+            "seq": row.seq,
+            "role": row.role,
+            "content": row.content,
+            "ts": row.created_at.timestamp(),
+        }
+        for row in reversed(rows)
+    ]
+
+
+_USAGE_COLUMNS = ("calls", "prompt_tokens", "cached_tokens", "output_tokens", "cost_usd")
+
+
+async def add_usage_daily(rows: list) -> None:
+    """
+    Add usage deltas to the daily totals, one multi-row upsert:
+    INSERT ... ON CONFLICT (day, scope, key) DO UPDATE SET col = col + excluded.col
+    """
+    if AsyncSessionLocal is None or not rows:
         return
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    values = [{**row, "day": date.fromisoformat(row["day"])} for row in rows]
+    stmt = insert(UsageDaily).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UsageDaily.day, UsageDaily.scope, UsageDaily.key],
+        set_={
+            name: getattr(UsageDaily, name) + getattr(stmt.excluded, name)
+            for name in _USAGE_COLUMNS
+        },
+    )
     async with AsyncSessionLocal() as session:
-        q = await session.execute(
-            select(UserProfile).where(UserProfile.user_external_id == user_external_id)
-        )
-        profile = q.scalars().first()
-        if profile:
-            profile.display_name = display_name
-            profile.companion_name = companion_name
-            profile.preferred_style = preferred_style
-        else:
-            profile = UserProfile(
-                user_external_id=user_external_id,
-                display_name=display_name,
-                companion_name=companion_name,
-                preferred_style=preferred_style,
-            )
-            session.add(profile)
+        await session.execute(stmt)
         await session.commit()
@@ -0,0 +1,126 @@
+# Per-request deadlines.
+#
+# DeadlineMiddleware gives every HTTP request an absolute deadline: the
+# route's default from REQUEST_DEADLINES (or REQUEST_DEADLINE_MS for routes
+# not listed), shortened, never extended, by an `X-Timeout-Ms` header from
+# the client. It lives in a context variable, so it follows the request into
+# the session turn, the generation queue, provider calls (resilience caps
+# each call's retry budget by it), stream reads and DB lookups. The header
+# cannot go below the moderation budget plus the generation reserve, so a
+# client cannot starve moderation on purpose.
+#
+# Each stage asks for what is left, not for its own fixed timeout:
+#
+#     timeout = budget(MODERATION_DEADLINE_S)   # min(cap, time left)
+#
+# and falls back when it runs out: a message that could not be moderated in
+# time gets a local degraded reply (never a model reply), generation gets a
+# degraded reply (or the partial stream), a history page what the session
+# store holds.
+
+import asyncio
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from metrics import counter
+
+REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", "10000"))
+ROUTE_DEADLINES_MS = {
+    "/start": 5000.0,
+    "/chat": 25000.0,
+    "/chat/stream": 60000.0,  # the whole stream, not just the first token
+}
+for _rule in filter(None, os.getenv("REQUEST_DEADLINES", "").split(",")):
+    _route, _, _ms = _rule.partition("=")
+    if _route.strip() and _ms.strip():
+        ROUTE_DEADLINES_MS[_route.strip()] = float(_ms)
+
+# Generation is what the user came for, so earlier optional stages
+# (moderation) leave at least this much of the budget for it.
+GENERATION_RESERVE_S = float(os.getenv("DEADLINE_GENERATION_RESERVE_MS", "5000")) / 1000.0
+
+# Moderation sits in front of every reply, so it gets a tighter budget.
+MODERATION_DEADLINE_S = float(os.getenv("MODERATION_DEADLINE_S", "5"))
+
+# Shortest deadline a client may ask for with X-Timeout-Ms.
+CLIENT_DEADLINE_FLOOR_S = MODERATION_DEADLINE_S + GENERATION_RESERVE_S
+
+FALLBACKS = counter(
+    "deadline_fallbacks_total",
+    "Stages cut short by the request deadline, by stage",
+)
+
+# absolute time.monotonic() deadline of the current request, if any
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before this stage could finish."""
+
+
+def set_deadline(seconds: Optional[float]):
+    """Give the current context `seconds` from now (None clears it)."""
+    _deadline.set(None if seconds is None else time.monotonic() + seconds)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left for the current request (may be <= 0), or None if unbounded."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def budget(cap: float, reserve: float = 0.0) -> float:
+    """min(cap, time left minus `reserve`); can be <= 0."""
+    left = remaining()
+    return cap if left is None else min(cap, left - reserve)
+
+
+def fallback(stage: str):
+    FALLBACKS.inc(stage=stage)
+
+
+async def within(awaitable, cap: Optional[float] = None):
+    """Await with the remaining budget (capped at `cap`); DeadlineExceeded on timeout."""
+    left = remaining()
+    timeout = cap if left is None else (left if cap is None else min(cap, left))
+    if timeout is None:
+        return await awaitable
+    if timeout <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded()
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded() from None
+
+
+def _route_deadline_s(scope) -> float:
+    seconds = ROUTE_DEADLINES_MS.get(scope["path"], REQUEST_DEADLINE_MS) / 1000.0
+    for name, value in scope["headers"]:
+        if name == b"x-timeout-ms":
+            try:
+                asked = float(value) / 1000.0
+            except ValueError:
+                break
+            if asked > 0:
+                seconds = min(seconds, max(asked, CLIENT_DEADLINE_FLOOR_S))
+            break
+    return seconds
+
+
+class DeadlineMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            set_deadline(_route_deadline_s(scope))
+        await self.app(scope, receive, send)
@@ -0,0 +1,191 @@
+# Degraded mode: local replies while the provider can't keep up.
+#
+# The mode is on while the provider circuit breaker is open, or while at
+# least DEGRADED_QUEUE_DEPTH turns are waiting for a generation slot in this
+# worker (until the queue drains below half of that). In it, chat turns are
+# answered at once from the templates below instead of queueing for, or
+# failing at, the provider. Replies follow the session's style, say that
+# they are short on purpose, and carry the usual disclaimer. They never quote
+# the user.
+#
+# In queue mode the provider is up, so messages are still moderated first
+# and the reply may react to a few broad moods in the message. With the
+# breaker open there is no moderation, and the opener stays neutral: mood
+# cues ("love", "won", "hate") show up in harmful messages too.
+#
+# Nothing has to switch the mode back: the breaker half-opens after its
+# cooldown (the next real turn is its probe) and queues drain on their own.
+# The mode is exported as the degraded_mode gauge and each switch is logged.
+
+import os
+import random
+import re
+from typing import Optional
+
+from admission import is_priority, queue_depth
+from logs import get_logger, log_event
+from metrics import counter, gauge
+from resilience import breaker
+
+DEGRADED_QUEUE_DEPTH = int(os.getenv("DEGRADED_QUEUE_DEPTH", "32"))  # 0 = breaker only
+
+MODE = gauge("degraded_mode", "1 while chat turns get local template replies, by reason")
+REPLIES = counter("degraded_replies_total", "Chat turns answered from local templates, by reason")
+
+logger = get_logger("degraded")
+
+DISCLAIMER = (
+    "\n\n(I’m an AI friend, not a therapist or doctor, "
+    "but I’m really glad you’re talking to me.)"
+)
+
+# (mood, words that suggest it); first match wins
+_MOODS = (
+    ("sad", ("sad", "cry", "crying", "down", "depressed", "heartbroken", "hurt", "miss", "lost", "grief")),
+    ("anxious", ("anxious", "anxiety", "worried", "worry", "nervous", "scared", "panic", "stressed", "stress", "overthinking")),
+    ("angry", ("angry", "mad", "furious", "annoyed", "frustrated", "hate", "unfair")),
+    ("tired", ("tired", "exhausted", "drained", "burnt", "burned", "sleep", "sleepy", "worn")),
+    ("lonely", ("lonely", "alone", "nobody", "isolated", "ignored", "left out")),
+    ("happy", ("happy", "excited", "great", "amazing", "proud", "won", "passed", "yay", "love")),
+    ("greeting", ("hi", "hey", "hello", "hiya", "morning", "evening", "sup")),
+)
+_WORD_RE = re.compile(r"[a-z']+")
+
+_OPENERS = {
+    "warm": {
+        "sad": ("That sounds really heavy, {user}. I’m sorry you’re carrying it. 💛",
+                "Oh {user}, that hurts. It makes sense that you feel this way."),
+        "anxious": ("That sounds like a lot to hold at once, {user}. Let’s slow down together.",
+                    "Worry can get so loud, {user}. You don’t have to sort it all out right now."),
+        "angry": ("That would frustrate me too, {user}. Your feelings are allowed here.",
+                  "It sounds like something really crossed a line for you, {user}."),
+        "tired": ("You sound worn out, {user}. Rest is not something you have to earn.",
+                  "That’s a lot of tired, {user}. Be gentle with yourself tonight."),
+        "lonely": ("I’m glad you reached out, {user}. Feeling alone is so hard.",
+                   "You’re not bothering me by being here, {user}. I’m glad you came."),
+        "happy": ("{user}, that’s wonderful! I love hearing this. ✨",
+                  "Yay, {user}! You deserve to enjoy this moment."),
+        "greeting": ("Hey {user}! It’s really good to hear from you. 💛",
+                     "Hi {user}, I’m so glad you stopped by."),
+        "other": ("Thank you for telling me this, {user}. I’m here with you.",
+                  "I hear you, {user}. What you’re feeling matters."),
+    },
+    "calm": {
+        "sad": ("That sounds painful, {user}. Let’s take a slow breath together.",
+                "It’s okay to feel sad, {user}. There’s no rush to feel anything else."),
+        "anxious": ("Let’s pause for a moment, {user}. Breathe in for four, out for six.",
+                    "One thing at a time, {user}. Right now you only need to take the next breath."),
+        "angry": ("That sounds frustrating, {user}. It’s okay to let it settle before deciding anything.",
+                  "Anger often points at something that matters to you, {user}."),
+        "tired": ("You sound tired, {user}. Maybe the kindest next step is a small rest.",
+                  "Let your shoulders drop for a moment, {user}. You’ve done enough for now."),
+        "lonely": ("You’re not alone in this moment, {user}. I’m here.",
+                   "Loneliness is heavy, {user}. Thank you for reaching out."),
+        "happy": ("That’s lovely, {user}. Let yourself take it in for a moment.",
+                  "I’m glad, {user}. Moments like this are worth noticing."),
+        "greeting": ("Hello {user}. It’s good to hear from you.",
+                     "Hi {user}. Take a breath and settle in."),
+        "other": ("Thank you for sharing that, {user}. Let’s take it slowly.",
+                  "I hear you, {user}. There’s no rush here."),
+    },
+    "playful": {
+        "sad": ("Oof, {user}, that’s a rough one. Sending you the biggest virtual blanket. 🫂",
+                "Aw {user}, that stinks. You’re allowed to be a little sad blob today."),
+        "anxious": ("Okay {user}, brain on overdrive, got it. Let’s turn the volume down a notch.",
+                    "Deep breath, {user}! Your worries are loud, but they’re not the boss of you."),
+        "angry": ("Ugh, {user}, that would make me want to yell into a pillow too.",
+                  "Wow, {user}, I’d be side-eyeing that so hard right now."),
+        "tired": ("{user}, you sound like a phone at 2% battery. Charging time?",
+                  "Sleepy {user} alert! Blankets and snacks are officially approved."),
+        "lonely": ("Hey {user}, you’ve got me! I’m a surprisingly good listener. ✨",
+                   "Knock knock, {user}, it’s me, your friendly companion. You’re not alone."),
+        "happy": ("{user}!! That’s amazing! Cue the confetti. 🎉",
+                  "Look at you go, {user}! Happy dance time."),
+        "greeting": ("Heyyy {user}! ✨ Good to see you!",
+                     "Hi hi {user}! What’s the vibe today?"),
+        "other": ("Got it, {user}. I’m all ears (well, figuratively). ✨",
+                  "Thanks for telling me, {user}. I’m here for it."),
+    },
+}
+
+_BRIEF = {
+    "warm": "My thoughts are running a little slow right now, so I’ll keep this short, but I’m still here.",
+    "calm": "I’m keeping my words brief for the moment, but I’m listening.",
+    "playful": "My brain is on low-power mode for a bit, so short and sweet today!",
+}
+
+_FOLLOW_UPS = {
+    "warm": ("Would you like to tell me a bit more?",
+             "What would feel most supportive right now?"),
+    "calm": ("What feels most important to you right now?",
+             "Would it help to name one small next step?"),
+    "playful": ("Wanna tell me more?",
+                "What’s one tiny thing that would make today better?"),
+}
+
+_mode_reason = None
+
+
+def _mood(text: str) -> str:
+    words = set(_WORD_RE.findall(text.lower()))
+    lower = text.lower()
+    for mood, cues in _MOODS:
+        if any((cue in lower) if " " in cue else (cue in words) for cue in cues):
+            return mood
+    return "other"
+
+
+def _switch(reason: Optional[str]):
+    global _mode_reason
+    if reason == _mode_reason:
+        return
+    if _mode_reason is not None:
+        MODE.set(0, reason=_mode_reason)
+    if reason is not None:
+        MODE.set(1, reason=reason)
+    log_event(logger, "degraded_mode", previous=_mode_reason, reason=reason, queued=queue_depth())
+    _mode_reason = reason
+
+
+def update_mode() -> Optional[str]:
+    """Re-evaluate the mode (also called at each scrape so the gauge is fresh)."""
+    if breaker.is_open():
+        reason = "breaker"
+    else:
+        depth = queue_depth()
+        if DEGRADED_QUEUE_DEPTH > 0 and (
+            depth >= DEGRADED_QUEUE_DEPTH
+            or (_mode_reason == "queue" and depth >= DEGRADED_QUEUE_DEPTH // 2)
+        ):
+            reason = "queue"
+        else:
+            reason = None
+    _switch(reason)
+    return reason
+
+
+def degraded_reason(session_id: str) -> Optional[str]:
+    """
+    "breaker" or "queue" when this session's turn should get a local reply,
+    else None. Priority sessions have reserved slots, so only the breaker
+    applies to them.
+    """
+    reason = update_mode()
+    if reason == "queue" and is_priority(session_id):
+        return None
+    return reason
+
+
+def degraded_reply(
+    user_message: str, user_name: str, style: str, reason: str, moderated: bool
+) -> str:
+    """
+    A short supportive reply in the session's style, with the disclaimer.
+    Only a `moderated` message gets a mood-specific opener.
+    """
+    REPLIES.inc(reason=reason)
+    style = style if style in _OPENERS else "warm"
+    mood = _mood(user_message) if moderated else "other"
+    opener = random.choice(_OPENERS[style][mood]).format(user=user_name)
+    follow_up = random.choice(_FOLLOW_UPS[style])
+    return f"{opener} {_BRIEF[style]} {follow_up}{DISCLAIMER}"
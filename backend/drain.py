@@ -0,0 +1,140 @@
+# Graceful drain on SIGTERM.
+#
+# The server's own SIGTERM handling (uvicorn's) closes the listening socket
+# and then gives open connections a fixed time before killing them, so a
+# deploy cuts streams mid-reply and those replies never reach history. At
+# startup we put a handler in front of it that first drains:
+#
+#   1. /health starts answering 503 so load balancers stop routing here, and
+#      new /chat/stream requests get 503 with Retry-After (crisis messages
+#      are still answered),
+#   2. in-flight streams get up to DRAIN_GRACE_S to finish; any still running
+#      then stop at their next chunk and store what they have,
+#   3. the server's handler runs and shutdown proceeds as before: the app's
+#      shutdown hook flushes write-behind buffers and writes a final metrics
+#      snapshot (write_metrics_snapshot) to METRICS_SNAPSHOT_PATH.
+#
+# A second SIGTERM skips the drain; SIGINT (Ctrl-C) is left alone. Only
+# installed when running under a server that handles SIGTERM on the main
+# thread, as uvicorn does.
+
+import asyncio
+import os
+import signal
+import tempfile
+import threading
+import time
+
+from logs import get_logger, log_event
+from metrics import gauge, render_prometheus
+
+DRAIN_ENABLED = os.getenv("DRAIN_ENABLED", "1") == "1"
+DRAIN_GRACE_S = float(os.getenv("DRAIN_GRACE_S", "20"))
+# keep serving (not ready) at least this long so load balancers notice
+DRAIN_MIN_S = float(os.getenv("DRAIN_MIN_S", "0"))
+DRAIN_RETRY_AFTER_S = int(os.getenv("DRAIN_RETRY_AFTER_S", "5"))
+# after the grace period: how long cut-off streams get to store their reply
+_CUTOFF_WAIT_S = 2.0
+METRICS_SNAPSHOT_PATH = os.getenv(
+    "METRICS_SNAPSHOT_PATH",
+    os.path.join(tempfile.gettempdir(), f"skylar-metrics-{os.getpid()}.prom"),
+)
+
+DRAINING = gauge("draining", "1 while this worker is draining for shutdown")
+STREAMS = gauge("chat_streams_active", "Open /chat/stream responses in this worker")
+
+logger = get_logger("drain")
+
+
+class _Drain:
+    def __init__(self):
+        self.draining = False
+        self.cutoff = False  # grace period over: streams should wrap up
+        self.streams = 0
+        self._task = None
+
+    def stream_started(self):
+        self.streams += 1
+        STREAMS.set(self.streams)
+
+    def stream_finished(self):
+        self.streams -= 1
+        STREAMS.set(self.streams)
+
+    async def _wait_streams(self, seconds: float):
+        until = time.monotonic() + seconds
+        while self.streams and time.monotonic() < until:
+            await asyncio.sleep(0.1)
+
+    async def run(self, resume):
+        started = time.monotonic()
+        self.draining = True
+        DRAINING.set(1)
+        log_event(logger, "drain_started", streams=self.streams, grace_s=DRAIN_GRACE_S)
+        await self._wait_streams(DRAIN_GRACE_S)
+        if self.streams:
+            self.cutoff = True
+            await self._wait_streams(_CUTOFF_WAIT_S)
+        left = DRAIN_MIN_S - (time.monotonic() - started)
+        if left > 0:
+            await asyncio.sleep(left)
+        log_event(
+            logger,
+            "drain_finished",
+            seconds=round(time.monotonic() - started, 2),
+            streams_left=self.streams,
+            cut_off=self.cutoff,
+        )
+        resume()
+
+
+_drain = _Drain()
+
+
+def install_drain_handler():
+    """Drain before the server's own SIGTERM handling (call from startup)."""
+    if not DRAIN_ENABLED or threading.current_thread() is not threading.main_thread():
+        return
+    original = signal.getsignal(signal.SIGTERM)
+    if not callable(original):
+        return  # no server handler to hand over to
+    loop = asyncio.get_running_loop()
+
+    def on_signal(sig, frame):
+        if _drain.draining:
+            original(sig, frame)  # asked twice: stop waiting
+            return
+        _drain.draining = True
+        loop.call_soon_threadsafe(_start, lambda: original(sig, frame))
+
+    def _start(resume):
+        _drain._task = asyncio.ensure_future(_drain.run(resume))
+
+    signal.signal(signal.SIGTERM, on_signal)
+
+
+def draining() -> bool:
+    return _drain.draining
+
+
+def streams_must_stop() -> bool:
+    """True once the grace period is over; streams should store and finish."""
+    return _drain.cutoff
+
+
+def stream_started():
+    _drain.stream_started()
+
+
+def stream_finished():
+    _drain.stream_finished()
+
+
+def write_metrics_snapshot():
+    """Write the final metrics in Prometheus text format (at shutdown)."""
+    try:
+        with open(METRICS_SNAPSHOT_PATH, "w") as f:
+            f.write(render_prometheus())
+    except OSError:
+        return
+    log_event(logger, "metrics_snapshot", path=METRICS_SNAPSHOT_PATH)
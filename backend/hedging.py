@@ -0,0 +1,250 @@
+# Hedged streaming requests (opt-in).
+#
+# With HEDGE_ENABLED=1, if the first token of a streamed reply has not
+# arrived after HEDGE_AFTER_MS (a number, or "p95" for the observed p95 time
+# to first token), a second identical request is sent to HEDGE_MODEL (default:
+# the same model). Whichever produces a token first wins; the other is
+# cancelled. Hedges are capped at HEDGE_MAX_PCT percent of requests per
+# HEDGE_WINDOW_S so a provider slowdown cannot double our spend. The loser is
+# recorded like any other call (tokens, cost), so hedging spend shows up in
+# the usage metrics, and the reply is charged to whichever model won.
+#
+# First-token latency is sampled even when hedging is off, so the p95 is
+# already warm when it gets turned on.
+#
+# Reading the stream after the first token is bounded by the request's
+# deadline: a stalled chunk raises deadline.DeadlineExceeded.
+
+import asyncio
+import os
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from deadline import within
+from llm_client import client
+from metrics import counter, gauge, histogram
+from resilience import call_with_retries
+from routing import record
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_AFTER_MS = os.getenv("HEDGE_AFTER_MS", "p95")
+# Used for "p95" until enough first-token samples have been seen.
+HEDGE_DEFAULT_AFTER_MS = float(os.getenv("HEDGE_DEFAULT_AFTER_MS", "2500"))
+HEDGE_MODEL = os.getenv("HEDGE_MODEL")
+HEDGE_MAX_PCT = float(os.getenv("HEDGE_MAX_PCT", "5"))
+HEDGE_WINDOW_S = float(os.getenv("HEDGE_WINDOW_S", "60"))
+
+_MIN_SAMPLES = 20
+
+FIRST_TOKEN = histogram(
+    "llm_first_token_seconds",
+    "Time from sending a streaming request to its first chunk",
+)
+HEDGES = counter(
+    "llm_hedges_total",
+    "Hedge decisions for slow first tokens (outcome=issued|over_budget)",
+)
+HEDGE_WINS = counter(
+    "llm_hedge_wins_total",
+    "Which request produced the first token when a hedge was issued",
+)
+HEDGE_RATE = gauge(
+    "llm_hedge_rate",
+    "Hedged requests / all streaming requests in the current budget window",
+)
+
+
+class _HedgeBudget:
+    """Fixed-window cap on hedges as a share of requests."""
+
+    def __init__(self, max_pct: float, window_s: float):
+        self.max_ratio = max_pct / 100.0
+        self.window_s = window_s
+        self._window_start = time.monotonic()
+        self.requests = 0
+        self.hedges = 0
+
+    def _roll(self):
+        now = time.monotonic()
+        if now - self._window_start >= self.window_s:
+            self._window_start = now
+            self.requests = 0
+            self.hedges = 0
+
+    def on_request(self):
+        self._roll()
+        self.requests += 1
+
+    def try_spend(self) -> bool:
+        self._roll()
+        if self.hedges + 1 > self.max_ratio * self.requests:
+            return False
+        self.hedges += 1
+        HEDGE_RATE.set(self.hedges / self.requests)
+        return True
+
+
+class _FirstTokenTracker:
+    def __init__(self, size: int = 256):
+        self._samples = deque(maxlen=size)
+        self._p95 = None
+        self._since_sort = 0
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+        self._since_sort += 1
+        if self._since_sort >= 16 and len(self._samples) >= _MIN_SAMPLES:
+            ordered = sorted(self._samples)
+            self._p95 = ordered[int(0.95 * (len(ordered) - 1))]
+            self._since_sort = 0
+
+    def p95(self):
+        return self._p95
+
+
+_budget = _HedgeBudget(HEDGE_MAX_PCT, HEDGE_WINDOW_S)
+_first_token = _FirstTokenTracker()
+
+
+def hedge_after_seconds() -> float:
+    if HEDGE_AFTER_MS != "p95":
+        return float(HEDGE_AFTER_MS) / 1000.0
+    p95 = _first_token.p95()
+    return p95 if p95 is not None else HEDGE_DEFAULT_AFTER_MS / 1000.0
+
+
+async def _open_once(model: str, contents):
+    stream = await client.aio.models.generate_content_stream(model=model, contents=contents)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = None
+    return stream, first
+
+
+async def _open(model: str, contents):
+    """
+    Start a stream and wait for its first chunk (None if it was empty).
+    Retries happen here, before anything has been shown to the user.
+    """
+    return await call_with_retries(lambda: _open_once(model, contents))
+
+
+def _discard(task: asyncio.Task):
+    """Cancel a losing request; close its stream if it already opened."""
+
+    def _close(t: asyncio.Task):
+        if t.cancelled() or t.exception() is not None:
+            return
+        stream, _ = t.result()
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            asyncio.ensure_future(aclose())
+
+    if task.done():
+        _close(task)
+    else:
+        task.cancel()
+        task.add_done_callback(_close)
+
+
+def _loser_usage(task: asyncio.Task, winner_first):
+    """
+    What a cancelled request is billed for: its own usage if it got a chunk,
+    else the winner's prompt tokens (same prompt) and no output.
+    """
+    if task.done() and not task.cancelled() and task.exception() is None:
+        _, first = task.result()
+        if first is not None and first.usage_metadata is not None:
+            return first.usage_metadata
+    usage = getattr(winner_first, "usage_metadata", None)
+    prompt = getattr(usage, "prompt_token_count", None)
+    if prompt is None:
+        return None
+    return SimpleNamespace(prompt_token_count=prompt, candidates_token_count=0)
+
+
+class HedgedStream:
+    """
+    Async iterator over response chunks, like
+    `await client.aio.models.generate_content_stream(...)`, but hedged.
+
+    `model` is the model that is answering once the first chunk is out
+    (HEDGE_MODEL when the hedge won). The request that lost is recorded
+    against `route` here; the caller records the winner as usual.
+    """
+
+    def __init__(self, model: str, contents, route: str):
+        self.model = model
+        self._contents = contents
+        self._route = route
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        _budget.on_request()
+        started = time.perf_counter()
+        primary = asyncio.ensure_future(_open(self.model, self._contents))
+        labels = {primary: "primary"}
+        models = {primary: self.model}
+        opened = {primary: started}
+        winner = None
+
+        try:
+            if HEDGE_ENABLED:
+                done, _ = await asyncio.wait({primary}, timeout=hedge_after_seconds())
+                if not done:
+                    if _budget.try_spend():
+                        HEDGES.inc(outcome="issued")
+                        hedge_model = HEDGE_MODEL or self.model
+                        hedge = asyncio.ensure_future(_open(hedge_model, self._contents))
+                        labels[hedge] = "hedge"
+                        models[hedge] = hedge_model
+                        opened[hedge] = time.perf_counter()
+                    else:
+                        HEDGES.inc(outcome="over_budget")
+
+            pending = set(labels)
+            error = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+            if winner is None:
+                raise error
+        finally:
+            for task in labels:
+                if task is not winner:
+                    _discard(task)
+
+        now = time.perf_counter()
+        elapsed = now - started
+        FIRST_TOKEN.observe(elapsed)
+        _first_token.add(elapsed)
+        stream, first = winner.result()
+        self.model = models[winner]
+        if len(labels) > 1:
+            HEDGE_WINS.inc(winner=labels[winner])
+            for task in labels:
+                if task is not winner:
+                    # the provider bills the cancelled request too
+                    record(self._route, models[task], now - opened[task], _loser_usage(task, first))
+
+        if first is not None:
+            yield first
+        chunks = stream.__aiter__()
+        while True:
+            try:
+                chunk = await within(chunks.__anext__())
+            except StopAsyncIteration:
+                return
+            yield chunk
+
+
+def hedged_stream(model: str, contents, route: str = "chat") -> HedgedStream:
+    return HedgedStream(model, contents, route)
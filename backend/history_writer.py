@@ -0,0 +1,141 @@
+# Write-behind persistence for conversation history.
+#
+# With HISTORY_PERSIST=1 and DATABASE_URL set, every message appended to the
+# session store is also queued here and flushed to the chat_messages table in
+# batches (one multi-row INSERT per flush) every HISTORY_FLUSH_INTERVAL_S, or
+# sooner once HISTORY_FLUSH_BATCH messages are waiting. The request path only
+# pays for a deque append; hot reads keep coming from the session store.
+#
+# The buffer is bounded by HISTORY_BUFFER_MAX; when the DB falls that far
+# behind, the oldest unsaved messages are dropped (and counted). stop() does
+# a final flush on shutdown.
+
+import asyncio
+import os
+from collections import deque
+from datetime import datetime, timezone
+
+from db import DATABASE_URL, insert_chat_messages
+from metrics import counter, gauge, histogram
+
+HISTORY_PERSIST = os.getenv("HISTORY_PERSIST", "0") == "1" and bool(DATABASE_URL)
+HISTORY_FLUSH_INTERVAL_S = float(os.getenv("HISTORY_FLUSH_INTERVAL_S", "0.5"))
+HISTORY_FLUSH_BATCH = int(os.getenv("HISTORY_FLUSH_BATCH", "500"))
+HISTORY_BUFFER_MAX = int(os.getenv("HISTORY_BUFFER_MAX", "50000"))
+
+QUEUE_DEPTH = gauge("history_write_queue_depth", "History messages waiting to be persisted")
+BATCH_SIZE = histogram(
+    "history_write_batch_size",
+    "Messages per history INSERT",
+    buckets=(1, 10, 50, 100, 250, 500, 1000),
+)
+FLUSH_LATENCY = histogram("history_write_flush_seconds", "Time per history INSERT")
+DROPPED = counter(
+    "history_write_dropped_total",
+    "History messages dropped because the write-behind buffer was full",
+)
+FAILURES = counter("history_write_failures_total", "History INSERTs that failed")
+
+
+class HistoryWriter:
+    def __init__(self, flush_interval_s: float, batch_size: int, buffer_max: int):
+        self.flush_interval_s = flush_interval_s
+        self.batch_size = max(1, batch_size)
+        self.buffer_max = max(self.batch_size, buffer_max)
+        self._buffer = deque()
+        self._wake = None
+        self._task = None
+
+    def enqueue(self, session_id: str, item: dict):
+        if len(self._buffer) >= self.buffer_max:
+            self._buffer.popleft()
+            DROPPED.inc()
+        self._buffer.append(
+            {
+                "session_id": session_id,
+                "seq": item["seq"],
+                "role": item["role"],
+                "content": item["content"],
+                "created_at": datetime.fromtimestamp(item["ts"], tz=timezone.utc),
+            }
+        )
+        QUEUE_DEPTH.set(len(self._buffer))
+        if self._wake is not None and len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop the flusher and write out everything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._buffer:
+            if not await self.flush():
+                break
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval_s)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            while self._buffer:
+                if not await self.flush():
+                    # DB unhappy: keep the rows and try again next interval
+                    break
+                if len(self._buffer) < self.batch_size:
+                    break
+
+    async def flush(self) -> bool:
+        """Write one batch; on failure the rows go back to the front."""
+        batch = []
+        while self._buffer and len(batch) < self.batch_size:
+            batch.append(self._buffer.popleft())
+        if not batch:
+            return True
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            await insert_chat_messages(batch)
+        except Exception:
+            FAILURES.inc()
+            room = self.buffer_max - len(self._buffer)
+            if room < len(batch):
+                DROPPED.inc(len(batch) - room)
+                batch = batch[len(batch) - room:]
+            self._buffer.extendleft(reversed(batch))
+            return False
+        finally:
+            QUEUE_DEPTH.set(len(self._buffer))
+        BATCH_SIZE.observe(len(batch))
+        FLUSH_LATENCY.observe(loop.time() - started)
+        return True
+
+
+_writer = HistoryWriter(HISTORY_FLUSH_INTERVAL_S, HISTORY_FLUSH_BATCH, HISTORY_BUFFER_MAX)
+
+
+def enqueue_message(session_id: str, item: dict):
+    """Queue a history item (as returned by the session store) for the DB."""
+    if HISTORY_PERSIST:
+        _writer.enqueue(session_id, item)
+
+
+def start_history_writer():
+    if HISTORY_PERSIST:
+        _writer.start()
+
+
+async def stop_history_writer():
+    if HISTORY_PERSIST:
+        await _writer.stop()
@@ -0,0 +1,46 @@
+# Per-route HTTP request metrics, as a plain ASGI middleware (no per-request
+# task or body buffering, so streaming responses pass straight through).
+#
+# Requests are labelled by route template ("/sessions/{session_id}/history"),
+# not the raw path, to keep label cardinality bounded. Duration runs until
+# the last body chunk is sent, so it covers the whole of a stream.
+
+import time
+
+from metrics import counter, histogram
+
+REQUESTS = counter("http_requests_total", "HTTP requests by route, method and status")
+LATENCY = histogram(
+    "http_request_duration_seconds",
+    "HTTP request duration by route and method (until the response is complete)",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # the router sets scope["route"] once a route has matched
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            REQUESTS.inc(route=path, method=method, status=status)
+            LATENCY.observe(time.perf_counter() - started, route=path, method=method)
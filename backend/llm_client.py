@@ -1,7 +1,12 @@
 import os
-from typing import List, Dict
+import time
+from typing import List, Dict, Optional
 from google import genai
 
+from routing import route_for_message, model_for, record
+from deadline import DeadlineExceeded
+from resilience import call_with_retries
+
 # If GEMINI_API_KEY is set in the environment, you can also just do:
 # client = genai.Client()
 client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
@@ -49,14 +54,24 @@ Always be clear: you are an AI friend, not a substitute for professional care.
 
 def build_prompt(system_text: str,
                  history: List[Dict[str, str]],
-                 user_message: str) -> str:
+                 user_message: str,
+                 memories: Optional[List[str]] = None) -> str:
     """
     Convert system + history + user message into a single text prompt
     that we send to Gemini via generate_content().
+    `memories` are relevant snippets from earlier conversations
+    (see memory_index.recall), already trimmed to the token budget.
     """
     lines: List[str] = []
     lines.append(system_text.strip())
     lines.append("")
+
+    if memories:
+        lines.append("Things you remember from earlier conversations "
+                     "(bring up only if it helps):")
+        for snippet in memories:
+            lines.append(snippet)
+            lines.append("")
     lines.append("Conversation so far:")
 
     # include last 10 exchanges max for context
@@ -71,25 +86,47 @@ def build_prompt(system_text: str,
     return "\n".join(lines)
 
 
-def generate_llm_reply(companion_name: str,
-                       history: List[Dict[str, str]],
-                       user_message: str) -> str:
+async def generate_llm_reply(companion_name: str,
+                             history: List[Dict[str, str]],
+                             user_message: str,
+                             memories: Optional[List[str]] = None,
+                             timer=None) -> str:
+    """`timer` (a stage_timer.StageTimer) gets "prompt" and "provider" marks."""
     system_text = BASE_SYSTEM_PROMPT.format(companion_name=companion_name)
-    prompt = build_prompt(system_text, history, user_message)
+    prompt = build_prompt(system_text, history, user_message, memories)
+    if timer is not None:
+        timer.mark("prompt")
+
+    route = route_for_message(user_message)
+    model = model_for(route)
 
     try:
-        # Gemini text generation call
-        # Docs pattern: client.models.generate_content(model="gemini-2.5-flash", contents="...") :contentReference[oaicite:0]{index=0}
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
+        # Gemini text generation call, retried on 429/5xx/timeouts
+        # Docs pattern: client.models.generate_content(model="gemini-2.5-flash", contents="...")
+        started = time.perf_counter()
+        response = await call_with_retries(
+            lambda: client.aio.models.generate_content(
+                model=model,
+                contents=prompt,
+            )
         )
+        record(route, model, time.perf_counter() - started, response.usage_metadata)
         reply = (response.text or "").strip()
+    except DeadlineExceeded:
+        # the caller has a better fallback than the line below
+        if timer is not None:
+            timer.mark("provider")
+        raise
     except Exception:
         reply = (
             "I got a bit tangled while trying to respond, "
             "but I’m still here with you."
         )
+        if timer is not None:
+            timer.note(outcome="error")
+    if timer is not None:
+        timer.mark("provider")
+        timer.note(model=model)
 
     # Make sure the safety disclaimer is present
     if "I’m an AI friend" not in reply and "I'm an AI friend" not in reply:
@@ -0,0 +1,24 @@
+# Structured logging for the backend's own events.
+#
+# Everything under the "skylar" logger is written as one JSON object per
+# line on stdout, unless the app has configured that logger itself.
+
+import json
+import logging
+import sys
+
+_root = logging.getLogger("skylar")
+if not _root.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _root.addHandler(_handler)
+    _root.setLevel(logging.INFO)
+    _root.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"skylar.{name}")
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, **fields):
+    logger.log(level, json.dumps({"event": event, **fields}, separators=(",", ":"), default=str))
@@ -0,0 +1,180 @@
+# Event-loop lag and threadpool saturation monitor.
+#
+# A monitor task sleeps LOOP_MONITOR_INTERVAL_MS at a time and records how
+# late it wakes up (event_loop_lag_seconds); on each wake-up it also reads
+# the threadpool that sync endpoints and run_in_threadpool use (anyio's
+# default limiter): threads busy, pool size, and tasks queued for a thread.
+#
+# A blocked loop cannot report on itself, so a watchdog thread watches the
+# monitor's heartbeat. Once the loop has been stuck for LOOP_LAG_THRESHOLD_MS
+# it logs the loop thread's stack as it is *right now*, i.e. the code that is
+# blocking it. Likewise, when tasks have been queued for the threadpool for
+# that long, the busy threads' stacks are logged. One log line per episode.
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+import anyio.to_thread
+
+from logs import get_logger, log_event
+from metrics import counter, gauge, histogram
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "1") == "1"
+LOOP_MONITOR_INTERVAL_S = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100")) / 1000.0
+LOOP_LAG_THRESHOLD_S = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "250")) / 1000.0
+
+LAG = histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop ran a timer that was due",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+LAG_LAST = gauge("event_loop_lag_last_seconds", "Most recent event loop lag sample")
+STALLS = counter("event_loop_stalls_total", "Times the loop was blocked past LOOP_LAG_THRESHOLD_MS")
+POOL_ACTIVE = gauge("threadpool_active_threads", "Threadpool threads running a task")
+POOL_SIZE = gauge("threadpool_size", "Threadpool capacity (thread limiter tokens)")
+POOL_QUEUED = gauge("threadpool_queue_depth", "Tasks waiting for a threadpool thread")
+POOL_SATURATIONS = counter(
+    "threadpool_saturations_total",
+    "Times tasks waited for a thread longer than LOOP_LAG_THRESHOLD_MS",
+)
+
+logger = get_logger("loop")
+
+# frames from these files are plumbing, not the code that blocked
+_SKIP_FILES = (os.sep + "asyncio" + os.sep, os.sep + "threading.py")
+
+
+def _stack(frame, limit: int = 30) -> list:
+    lines = []
+    for entry in traceback.extract_stack(frame)[-limit:]:
+        if any(part in entry.filename for part in _SKIP_FILES):
+            continue
+        lines.append(f"{entry.filename}:{entry.lineno} {entry.name}: {entry.line}")
+    return lines
+
+
+def _idle(frame) -> bool:
+    """True for a pool worker parked on its job queue."""
+    while frame is not None and frame.f_code.co_filename.endswith("threading.py"):
+        frame = frame.f_back
+    return frame is not None and frame.f_code.co_filename.endswith("queue.py")
+
+
+class LoopMonitor:
+    def __init__(self, interval_s: float, threshold_s: float):
+        self.interval_s = interval_s
+        self.threshold_s = threshold_s
+        self._task = None
+        self._watchdog = None
+        self._stop = threading.Event()
+        self._loop = None
+        self._loop_thread = None
+        self._beat = time.monotonic()
+        self._queued_since = None
+        self._pool_reported = False
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.ensure_future(self._run())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval_s)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - before - self.interval_s)
+            LAG.observe(lag)
+            LAG_LAST.set(lag)
+
+            stats = limiter.statistics()
+            POOL_ACTIVE.set(stats.borrowed_tokens)
+            POOL_SIZE.set(stats.total_tokens)
+            POOL_QUEUED.set(stats.tasks_waiting)
+            self._check_pool(stats.tasks_waiting, now)
+
+    def _check_pool(self, queued: int, now: float):
+        if not queued:
+            self._queued_since = None
+            self._pool_reported = False
+            return
+        if self._queued_since is None:
+            self._queued_since = now
+        if self._pool_reported or now - self._queued_since < self.threshold_s:
+            return
+        # saturated long enough: report once until the queue drains
+        self._pool_reported = True
+        waited_ms = round((now - self._queued_since) * 1000, 1)
+        POOL_SATURATIONS.inc()
+        frames = sys._current_frames()
+        busy = [
+            _stack(frames[thread.ident])
+            for thread in threading.enumerate()
+            # anyio names its pool threads this way
+            if thread.name.startswith("AnyIO worker")
+            and thread.ident in frames
+            and not _idle(frames[thread.ident])
+        ]
+        log_event(logger, "threadpool_saturated", queued=queued, waited_ms=waited_ms, threads=busy)
+
+    def _watch(self):
+        reported = False
+        while not self._stop.wait(self.interval_s):
+            # how far past its due time the monitor's next wake-up is
+            stalled = time.monotonic() - self._beat - self.interval_s
+            if stalled < self.threshold_s:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread)
+            task = None
+            try:
+                current = asyncio.current_task(self._loop)
+                task = current.get_name() if current is not None else None
+            except RuntimeError:
+                pass
+            log_event(
+                logger,
+                "event_loop_stall",
+                stalled_ms=round(stalled * 1000, 1),
+                task=task,
+                stack=_stack(frame) if frame is not None else [],
+            )
+
+
+_monitor = LoopMonitor(LOOP_MONITOR_INTERVAL_S, LOOP_LAG_THRESHOLD_S)
+
+
+def start_loop_monitor():
+    if LOOP_MONITOR_ENABLED:
+        _monitor.start()
+
+
+async def stop_loop_monitor():
+    await _monitor.stop()
@@ -1,26 +1,92 @@
+import asyncio
+import logging
 import uuid
 import os
-from fastapi import FastAPI, HTTPException
+import time
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 
 from llm_client import (
     generate_llm_reply,
     BASE_SYSTEM_PROMPT,
     build_prompt,  # Gemini-style prompt builder
-    client,        # google.genai Client
 )
-from safety import is_crisis_text, crisis_safe_reply, moderate_text
+from hedging import hedged_stream
+from memory_index import recall, remember
+from safety import is_crisis_text, crisis_safe_reply
+from moderation_batcher import moderate_text_batched
 from redis_client import (
     save_session_meta,
     get_session_meta,
     append_history,
     get_history,
+    get_history_page,
+    session_stats,
+    SessionStoreFull,
 )
-from db import init_db_if_configured
+from routing import route_for_message, model_for, record
+from db import init_db_if_configured, get_chat_messages
+from history_writer import HISTORY_PERSIST, start_history_writer, stop_history_writer
+from profile_cache import cached_profile, load_or_create_profile
+from metrics import counter, gauge, histogram, render_prometheus
+from http_metrics import RequestMetricsMiddleware
+from turns import session_turn, TurnWaitTimeout
+from admission import SlotWaitTimeout, generation_slot, mark_priority
+from degraded import DISCLAIMER, degraded_reason, degraded_reply, update_mode
+from deadline import DeadlineExceeded, DeadlineMiddleware, budget, fallback, within
+from drain import (
+    DRAIN_RETRY_AFTER_S,
+    draining,
+    install_drain_handler,
+    stream_finished,
+    stream_started,
+    streams_must_stop,
+    write_metrics_snapshot,
+)
+from logs import get_logger, log_event
+from loop_monitor import start_loop_monitor, stop_loop_monitor
+from usage_ledger import over_budget, set_owner, start_usage_flusher, stop_usage_flusher
+from stage_timer import StageTimer
+from tracing import TRACING_ENABLED, TracingMiddleware, start_trace_exporter, stop_trace_exporter
+from request_profiler import (
+    PROFILER_ENABLED,
+    ProfilingMiddleware,
+    list_profiles,
+    profile_path,
+    profile_text,
+    token_ok,
+)
+
+# How long /start waits on the DB for a profile before answering with defaults.
+PROFILE_DEADLINE_S = float(os.getenv("PROFILE_DEADLINE_MS", "150")) / 1000.0
+
+# Sessions with a message in this window count as active in /metrics.
+ACTIVE_SESSION_WINDOW_S = float(os.getenv("ACTIVE_SESSION_WINDOW_S", "300"))
+
+START_LATENCY = histogram(
+    "start_latency_seconds",
+    "/start latency by profile path (none/cache_hit/db/timeout/error)",
+)
+CRISIS_HITS = counter("crisis_detected_total", "Messages answered with the crisis reply, by endpoint")
+STREAM_TTFT = histogram(
+    "chat_stream_ttft_seconds",
+    "/chat/stream time from request to first model token",
+)
+STREAM_TOKENS_PER_S = histogram(
+    "chat_stream_tokens_per_second",
+    "/chat/stream output tokens per second after the first token",
+    buckets=(5, 10, 20, 40, 80, 160, 320, 640),
+)
+SESSIONS_STORED = gauge("sessions_stored", "Sessions held by the session store")
+SESSIONS_ACTIVE = gauge("sessions_active", "Sessions with a message in the last ACTIVE_SESSION_WINDOW_S")
+
+_background_tasks = set()
+
+logger = get_logger("app")
 
 app = FastAPI(
     title="CompanionBot Plus",
@@ -31,6 +97,15 @@ app = FastAPI(
     version="2.0.0",
 )
 
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(RequestMetricsMiddleware)
+if PROFILER_ENABLED:
+    # not installed at all unless PROFILER_TOKEN / PROFILER_SAMPLE_RATE is set
+    app.add_middleware(ProfilingMiddleware)
+if TRACING_ENABLED:
+    # likewise only with TRACE_SAMPLE_RATE > 0
+    app.add_middleware(TracingMiddleware)
+
 # CORS for dev; restrict origins in production
 app.add_middleware(
     CORSMiddleware,
@@ -64,14 +139,62 @@ class ChatResponse(BaseModel):
     reply: str
 
 
+class HistoryMessage(BaseModel):
+    seq: int
+    role: str
+    content: str
+    ts: float
+
+
+class HistoryPage(BaseModel):
+    session_id: str
+    messages: List[HistoryMessage]
+    next_cursor: Optional[int]  # pass as ?before= for the previous page
+
+
 @app.on_event("startup")
 async def on_startup():
     # Safe: only runs if DATABASE_URL is set. No-op otherwise.
     await init_db_if_configured()
+    start_history_writer()
+    start_loop_monitor()
+    start_usage_flusher()
+    start_trace_exporter()
+    install_drain_handler()
+
+
+async def _wait_background_tasks():
+    if _background_tasks:
+        await asyncio.wait(list(_background_tasks), timeout=5)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # In order, each on its own: one failing step (say, the DB is down)
+    # must not skip the others, least of all the final metrics snapshot.
+    steps = (
+        # let background work that still writes history (crisis exchanges,
+        # profile reconciles) land first
+        _wait_background_tasks,
+        # persist any history still waiting in the write-behind buffer
+        stop_history_writer,
+        stop_loop_monitor,
+        stop_usage_flusher,
+        stop_trace_exporter,
+        write_metrics_snapshot,
+    )
+    for step in steps:
+        try:
+            result = step()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as exc:
+            log_event(logger, "shutdown_step_failed", logging.ERROR, step=step.__name__, error=repr(exc))
 
 
 @app.post("/start", response_model=StartSessionResponse)
 async def start_session(req: StartSessionRequest):
+    started = time.perf_counter()
     user_name = req.user_name.strip()
     if not user_name:
         raise HTTPException(status_code=400, detail="user_name is required")
@@ -82,28 +205,26 @@ async def start_session(req: StartSessionRequest):
 
     companion_name = (req.companion_name or "Luna").strip()
 
-    # Optional persistent profile (only if DATABASE_URL + user_external_id configured)
-    if req.user_external_id:
-        try:
-            from db import upsert_user_profile, get_user_profile
-
-            profile = await get_user_profile(req.user_external_id)
-            if profile:
-                companion_name = profile.companion_name
-                style = profile.preferred_style
-            else:
-                await upsert_user_profile(
-                    user_external_id=req.user_external_id,
-                    display_name=user_name,
-                    companion_name=companion_name,
-                    preferred_style=style,
-                )
-        except Exception:
-            # If DB not configured / broken, ignore and continue
-            pass
-
+    # Optional persistent profile (only if DATABASE_URL + user_external_id configured).
+    # Cache first; the DB gets PROFILE_DEADLINE_MS before we answer with the
+    # requested values and let the lookup finish in the background.
     session_id = str(uuid.uuid4())
-    save_session_meta(session_id, user_name, companion_name, style)
+    path = "none"
+    if req.user_external_id:
+        profile, path = await _start_profile(
+            session_id, req.user_external_id, user_name, companion_name, style
+        )
+        if profile:
+            companion_name = profile["companion_name"]
+            style = profile["preferred_style"]
+
+    try:
+        save_session_meta(session_id, user_name, companion_name, style, req.user_external_id)
+    except SessionStoreFull:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many open conversations right now. Try again in a moment.",
+        )
 
     opening = (
         f"Hey {user_name} ✨ I’m {companion_name}. "
@@ -114,6 +235,7 @@ async def start_session(req: StartSessionRequest):
 
     append_history(session_id, "assistant", opening)
 
+    START_LATENCY.observe(time.perf_counter() - started, path=path)
     return StartSessionResponse(
         session_id=session_id,
         opening_message=opening,
@@ -122,13 +244,152 @@ async def start_session(req: StartSessionRequest):
     )
 
 
+async def _start_profile(session_id, user_external_id, user_name, companion_name, style):
+    """Return (profile or None, path) where path is cache_hit/db/timeout/error."""
+    profile = cached_profile(user_external_id)
+    if profile is not None:
+        return profile, "cache_hit"
+
+    lookup = asyncio.ensure_future(
+        load_or_create_profile(
+            user_external_id=user_external_id,
+            display_name=user_name,
+            companion_name=companion_name,
+            preferred_style=style,
+        )
+    )
+    try:
+        timeout = max(0.0, budget(PROFILE_DEADLINE_S))
+        return await asyncio.wait_for(asyncio.shield(lookup), timeout), "db"
+    except asyncio.TimeoutError:
+        _spawn(_reconcile_profile(session_id, user_name, lookup))
+        return None, "timeout"
+    except Exception:
+        # If DB not configured / broken, ignore and continue
+        return None, "error"
+
+
+async def _reconcile_profile(session_id, user_name, lookup):
+    """Finish a slow profile lookup and apply the stored profile to the session."""
+    profile = await lookup
+    meta = get_session_meta(session_id)
+    if not profile or not meta:
+        return
+    if (
+        meta["companion_name"] != profile["companion_name"]
+        or meta["style"] != profile["preferred_style"]
+    ):
+        save_session_meta(
+            session_id,
+            user_name,
+            profile["companion_name"],
+            profile["preferred_style"],
+            meta.get("user_external_id"),
+        )
+
+
+def _spawn(coro):
+    """Run a fire-and-forget task, keeping a reference until it finishes."""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    # background failures (e.g. DB down) are not the request's problem
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+
+def _user_key(session_id: str) -> str:
+    # Who the daily budget and the fair queue count a turn against. The
+    # session, not user_external_id: that id is not authenticated, so keying
+    # by it would let anyone spend someone else's budget (same reason as
+    # _recall_memories). Switch here once there is a verified user identity.
+    return session_id
+
+
+def _budget_reply(user_name: str) -> str:
+    return (
+        f"{user_name}, we’ve talked a lot today and I need to rest my thoughts "
+        "until tomorrow 🌙 If anything feels heavy before then, please reach out "
+        "to someone you trust or a local support line. 💛"
+    )
+
+
+def _busy_reply(user_name: str) -> str:
+    return (
+        f"Sorry {user_name}, a lot of people are talking to me right now and I "
+        "couldn’t get to you in time. Could you send that again in a minute? 💛"
+    )
+
+
+def _crisis_reply(session_id: str, meta: dict, user_msg: str, endpoint: str) -> str:
+    """
+    Answer a crisis message without waiting for the session turn or the
+    moderation call, and move the session to the priority lane.
+    """
+    CRISIS_HITS.inc(endpoint=endpoint)
+    mark_priority(session_id)
+    reply = crisis_safe_reply(meta["user_name"], meta["companion_name"])
+    _spawn(_record_crisis(session_id, user_msg, reply))
+    return reply
+
+
+async def _record_crisis(session_id: str, user_msg: str, reply: str):
+    """Add a crisis exchange to history in turn order, after the reply went out."""
+    try:
+        async with session_turn(session_id):
+            append_history(session_id, "user", user_msg)
+            append_history(session_id, "assistant", reply)
+            return
+    except TurnWaitTimeout:
+        pass
+    # the turn in front is stuck; out of order beats lost
+    append_history(session_id, "user", user_msg)
+    append_history(session_id, "assistant", reply)
+
+
+async def _crisis_stream(reply: str, timer: StageTimer):
+    try:
+        yield timer.sse_comment()
+        yield f"data: {reply}\n\n"
+        yield "data: [END]\n\n"
+    finally:
+        timer.log()
+
+
+def _recall_memories(session_id: str, history: list, user_msg: str):
+    """
+    Relevant earlier exchanges not already in the prompt's history window.
+
+    Memories stay within the session: user_external_id is whatever the client
+    sent to /start, so keying them by it would let anyone who knows an id
+    pull that user's past conversations into their own prompt.
+    """
+    window = history[-10:]
+    min_seq = window[0]["seq"] if window else 0
+    return recall(session_id, user_msg, session_id, min_seq)
+
+
+def _remember_later(session_id: str, user_msg: str, reply_item: dict):
+    """Index the exchange once the current request has moved on."""
+    asyncio.get_running_loop().call_soon(
+        remember,
+        session_id,
+        user_msg,
+        reply_item["content"],
+        session_id,
+        reply_item["seq"],
+    )
+
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest):
+async def chat(req: ChatRequest, response: Response):
     """
     Non-streaming chat endpoint (simple JSON response).
     Uses generate_llm_reply() which already calls Gemini.
     """
+    timer = StageTimer("/chat")
     meta = get_session_meta(req.session_id)
+    timer.mark("session")
     if not meta:
         raise HTTPException(status_code=404, detail="Session not found. Start a new one.")
 
@@ -136,21 +397,75 @@ async def chat(req: ChatRequest):
     if not user_msg:
         raise HTTPException(status_code=400, detail="Message cannot be empty.")
 
+    # Crisis messages skip the turn queue and moderation entirely.
+    if is_crisis_text(user_msg):
+        reply = _crisis_reply(req.session_id, meta, user_msg, "chat")
+        timer.mark("crisis")
+        timer.note(outcome="crisis")
+        response.headers["Server-Timing"] = timer.server_timing()
+        timer.log()
+        return ChatResponse(reply=reply)
+
+    try:
+        async with session_turn(req.session_id):
+            timer.mark("turn_wait")
+            result = await _chat_turn(req.session_id, meta, user_msg, timer)
+    except TurnWaitTimeout:
+        timer.mark("turn_wait")
+        timer.note(outcome="turn_timeout")
+        timer.log()
+        raise HTTPException(
+            status_code=429,
+            detail="Still answering your previous message. Try again in a moment.",
+            headers={"Server-Timing": timer.server_timing()},
+        )
+    response.headers["Server-Timing"] = timer.server_timing()
+    timer.log()
+    return result
+
+
+async def _chat_turn(session_id: str, meta: dict, user_msg: str, timer: StageTimer) -> ChatResponse:
     user_name = meta["user_name"]
     companion_name = meta["companion_name"]
 
-    append_history(req.session_id, "user", user_msg)
-    history = get_history(req.session_id)
+    set_owner(session_id, _user_key(session_id))
+    append_history(session_id, "user", user_msg)
+    history = get_history(session_id)
+    timer.mark("history")
+
+    # Daily token budget (crisis replies never count against it)
+    user_key = _user_key(session_id)
+    if over_budget(user_key):
+        timer.note(outcome="over_budget")
+        reply = _budget_reply(user_name)
+        append_history(session_id, "assistant", reply)
+        return ChatResponse(reply=reply)
 
-    # Crisis check
-    if is_crisis_text(user_msg):
-        reply = crisis_safe_reply(user_name, companion_name)
-        append_history(req.session_id, "assistant", reply)
+    # Provider down: answer locally, right away (no moderation possible)
+    degraded = degraded_reason(session_id)
+    if degraded == "breaker":
+        timer.note(outcome="degraded", degraded=degraded)
+        reply = degraded_reply(
+            user_msg, user_name, meta.get("style", "warm"), degraded, moderated=False
+        )
+        append_history(session_id, "assistant", reply)
         return ChatResponse(reply=reply)
 
     # Moderation
-    flagged, _ = moderate_text(user_msg)
+    try:
+        flagged, _ = await moderate_text_batched(user_msg)
+    except DeadlineExceeded:
+        # no verdict in time: never send an unchecked message to the model
+        timer.mark("moderation")
+        timer.note(outcome="deadline")
+        reply = degraded_reply(
+            user_msg, user_name, meta.get("style", "warm"), "deadline", moderated=False
+        )
+        append_history(session_id, "assistant", reply)
+        return ChatResponse(reply=reply)
+    timer.mark("moderation")
     if flagged:
+        timer.note(outcome="flagged")
         safe_msg = (
             f"{user_name}, thank you for trusting me. "
             "Some of what you shared touches topics I’m not allowed to go into. "
@@ -158,12 +473,43 @@ async def chat(req: ChatRequest):
             "but I can’t help with anything harmful or illegal."
             "\n\n_(I’m an AI friend, not a therapist or lawyer.)_"
         )
-        append_history(req.session_id, "assistant", safe_msg)
+        append_history(session_id, "assistant", safe_msg)
         return ChatResponse(reply=safe_msg)
 
+    # Queue too deep: answer locally instead of waiting for a slot
+    if degraded:
+        timer.note(outcome="degraded", degraded=degraded)
+        reply = degraded_reply(
+            user_msg, user_name, meta.get("style", "warm"), degraded, moderated=True
+        )
+        append_history(session_id, "assistant", reply)
+        return ChatResponse(reply=reply)
+
     # LLM reply (Gemini via generate_llm_reply)
-    reply = generate_llm_reply(companion_name, history, user_msg)
-    append_history(req.session_id, "assistant", reply)
+    memories = _recall_memories(session_id, history, user_msg)
+    timer.mark("memory")
+    timer.note(outcome="reply")
+    try:
+        async with generation_slot(session_id, user_key):
+            timer.mark("queue")
+            reply = await generate_llm_reply(companion_name, history, user_msg, memories, timer)
+    except SlotWaitTimeout:
+        timer.mark("queue")
+        timer.note(outcome="busy")
+        reply = _busy_reply(user_name)
+        append_history(session_id, "assistant", reply)
+        return ChatResponse(reply=reply)
+    except DeadlineExceeded:
+        timer.note(outcome="deadline")
+        fallback("generation")
+        reply = degraded_reply(
+            user_msg, user_name, meta.get("style", "warm"), "deadline", moderated=True
+        )
+        append_history(session_id, "assistant", reply)
+        return ChatResponse(reply=reply)
+    item = append_history(session_id, "assistant", reply)
+    _remember_later(session_id, user_msg, item)
+    timer.mark("store")
     return ChatResponse(reply=reply)
 
 
@@ -173,7 +519,9 @@ async def chat_stream(req: ChatRequest):
     Streaming endpoint using Server-Sent Events (SSE).
     Now uses Gemini streaming: client.models.generate_content_stream().
     """
+    timer = StageTimer("/chat/stream")
     meta = get_session_meta(req.session_id)
+    timer.mark("session")
     if not meta:
         raise HTTPException(status_code=404, detail="Session not found. Start a new one.")
 
@@ -181,26 +529,109 @@ async def chat_stream(req: ChatRequest):
     if not user_msg:
         raise HTTPException(status_code=400, detail="Message cannot be empty.")
 
-    user_name = meta["user_name"]
-    companion_name = meta["companion_name"]
+    if is_crisis_text(user_msg):
+        reply = _crisis_reply(req.session_id, meta, user_msg, "chat_stream")
+        timer.mark("crisis")
+        timer.note(outcome="crisis")
+        return StreamingResponse(
+            _crisis_stream(reply, timer),
+            media_type="text/event-stream",
+            headers={"Server-Timing": timer.server_timing()},
+        )
 
-    append_history(req.session_id, "user", user_msg)
-    history = get_history(req.session_id)
+    # Shutting down: send the client to another worker
+    if draining():
+        raise HTTPException(
+            status_code=503,
+            detail="Restarting. Please try again in a few seconds.",
+            headers={"Retry-After": str(DRAIN_RETRY_AFTER_S)},
+        )
 
-    # 1) Crisis handling: send one safe message, no token stream
-    if is_crisis_text(user_msg):
-        crisis = crisis_safe_reply(user_name, companion_name)
-        append_history(req.session_id, "assistant", crisis)
+    # Only the pre-stream stages fit in the header; the rest of the
+    # breakdown goes out as an SSE comment before the first token.
+    return StreamingResponse(
+        _stream_turn(req.session_id, meta, user_msg, timer),
+        media_type="text/event-stream",
+        headers={"Server-Timing": timer.server_timing()},
+    )
 
-        def crisis_gen():
-            yield f"data: {crisis}\n\n"
-            yield "data: [END]\n\n"
 
-        return StreamingResponse(crisis_gen(), media_type="text/event-stream")
+async def _stream_turn(session_id: str, meta: dict, user_msg: str, timer: StageTimer):
+    """
+    The whole turn runs inside the generator so the session's turn is held
+    for exactly as long as the stream is open.
+    """
+    stream_started()
+    try:
+        try:
+            async with session_turn(session_id) as turn:
+                timer.mark("turn_wait")
+                async for event in _stream_events(session_id, meta, user_msg, turn, timer):
+                    yield event
+        except TurnWaitTimeout:
+            timer.mark("turn_wait")
+            timer.note(outcome="turn_timeout")
+            yield timer.sse_comment()
+            yield (
+                "data: I’m still finishing my last reply. "
+                "Give me a moment and send that again? 💛\n\n"
+            )
 
-    # 2) Moderation handling
-    flagged, _ = moderate_text(user_msg)
+        # Signal end of stream
+        yield "data: [END]\n\n"
+    finally:
+        # also runs when the client disconnects mid-stream
+        stream_finished()
+        timer.log()
+
+
+async def _stream_events(session_id: str, meta: dict, user_msg: str, turn, timer: StageTimer):
+    user_name = meta["user_name"]
+    companion_name = meta["companion_name"]
+
+    set_owner(session_id, _user_key(session_id))
+    append_history(session_id, "user", user_msg)
+    history = get_history(session_id)
+    timer.mark("history")
+
+    # (crisis messages were answered before the turn was taken)
+    user_key = _user_key(session_id)
+    if over_budget(user_key):
+        timer.note(outcome="over_budget")
+        reply = _budget_reply(user_name)
+        append_history(session_id, "assistant", reply)
+        yield timer.sse_comment()
+        yield f"data: {reply}\n\n"
+        return
+
+    degraded = degraded_reason(session_id)
+    if degraded == "breaker":
+        timer.note(outcome="degraded", degraded=degraded)
+        reply = degraded_reply(
+            user_msg, user_name, meta.get("style", "warm"), degraded, moderated=False
+        )
+        append_history(session_id, "assistant", reply)
+        yield timer.sse_comment()
+        yield f"data: {reply}\n\n"
+        return
+
+    # 1) Moderation handling
+    try:
+        flagged, _ = await moderate_text_batched(user_msg)
+    except DeadlineExceeded:
+        # no verdict in time: never send an unchecked message to the model
+        timer.mark("moderation")
+        timer.note(outcome="deadline")
+        reply = degraded_reply(
+            user_msg, user_name, meta.get("style", "warm"), "deadline", moderated=False
+        )
+        append_history(session_id, "assistant", reply)
+        yield timer.sse_comment()
+        yield f"data: {reply}\n\n"
+        return
+    timer.mark("moderation")
     if flagged:
+        timer.note(outcome="flagged")
         safe_msg = (
             f"{user_name}, thank you for trusting me. "
             "Some of what you shared touches topics I’m not allowed to go into. "
@@ -208,70 +639,236 @@ async def chat_stream(req: ChatRequest):
             "but I can’t help with anything harmful or illegal."
             "\n\n_(I’m an AI friend, not a therapist or lawyer.)_"
         )
-        append_history(req.session_id, "assistant", safe_msg)
-
-        def safe_gen():
-            yield f"data: {safe_msg}\n\n"
-            yield "data: [END]\n\n"
-
-        return StreamingResponse(safe_gen(), media_type="text/event-stream")
-
-    # 3) Normal LLM streaming with Gemini
+        append_history(session_id, "assistant", safe_msg)
+        yield timer.sse_comment()
+        yield f"data: {safe_msg}\n\n"
+        return
+
+    if degraded:
+        timer.note(outcome="degraded", degraded=degraded)
+        reply = degraded_reply(
+            user_msg, user_name, meta.get("style", "warm"), degraded, moderated=True
+        )
+        append_history(session_id, "assistant", reply)
+        yield timer.sse_comment()
+        yield f"data: {reply}\n\n"
+        return
+
+    # A newer message already replaced this one; let that turn answer both.
+    if turn.superseded():
+        timer.note(outcome="superseded")
+        return
+
+    # 2) Normal LLM streaming with Gemini
+    memories = _recall_memories(session_id, history, user_msg)
+    timer.mark("memory")
     prompt = build_prompt(
         BASE_SYSTEM_PROMPT.format(companion_name=companion_name),
         history,
         user_msg,
+        memories,
     )
 
-    def event_stream():
-        full_reply = ""
-
-        try:
-            # Official streaming pattern with google-genai:
-            # for chunk in client.models.generate_content_stream(...): print(chunk.text) :contentReference[oaicite:2]{index=2}
-            stream = client.models.generate_content_stream(
-                model="gemini-2.5-flash",
-                contents=prompt,
-            )
-
-            for chunk in stream:
+    full_reply = ""
+    route = route_for_message(user_msg)
+    model = model_for(route)
+    timer.mark("prompt")
+    timer.note(outcome="reply", model=model)
+
+    try:
+        # Async streaming so the session turn can be held without a thread;
+        # hedged_stream() wraps client.aio.models.generate_content_stream().
+        async with generation_slot(session_id, user_key):
+            timer.mark("queue")
+            started = time.perf_counter()
+            stream = hedged_stream(model, prompt, route)
+
+            usage = None
+            first_token_at = None
+            async for chunk in stream:
+                # superseded, or shutting down: stop and store what we have
+                if turn.superseded() or streams_must_stop():
+                    break
+                usage = chunk.usage_metadata or usage
                 delta = (chunk.text or "").strip()
                 if delta:
+                    if first_token_at is None:
+                        # provider queueing + hedging + time to first token
+                        timer.mark("first_token")
+                        first_token_at = time.perf_counter()
+                        STREAM_TTFT.observe(timer.total())
+                        yield timer.sse_comment()
                     full_reply += delta
+                    timer.event("chunk", chars=len(delta))
                     yield f"data: {delta}\n\n"
 
-            # Ensure disclaimer footer
-            if (
-                "I’m an AI friend" not in full_reply
-                and "I'm an AI friend" not in full_reply
-            ):
-                footer = (
-                    "\n\n(I’m an AI friend, not a therapist or doctor, "
-                    "but I’m really glad you’re talking to me.)"
-                )
-                full_reply += footer
-                yield f"data: {footer}\n\n"
-
-            append_history(req.session_id, "assistant", full_reply)
-
-        except Exception:
-            # We can't distinguish rate limit vs other errors easily here,
-            # so use one gentle fallback.
-            msg = (
-                "I ran into an issue talking to my model just now. "
-                "Can we try again in a bit? 💛"
+            finished = time.perf_counter()
+        timer.mark("stream" if first_token_at is not None else "first_token")
+        # the hedge may have answered from HEDGE_MODEL
+        record(route, stream.model, finished - started, usage)
+        if first_token_at is not None and finished > first_token_at:
+            tokens = getattr(usage, "candidates_token_count", None) or len(full_reply) / 4
+            STREAM_TOKENS_PER_S.observe(tokens / (finished - first_token_at))
+
+        if turn.superseded():
+            timer.note(outcome="superseded")
+            # Keep what the user already saw, without the footer.
+            if full_reply:
+                append_history(session_id, "assistant", full_reply)
+            return
+
+        # Ensure disclaimer footer
+        if (
+            "I’m an AI friend" not in full_reply
+            and "I'm an AI friend" not in full_reply
+        ):
+            footer = DISCLAIMER
+            full_reply += footer
+            yield f"data: {footer}\n\n"
+
+        item = append_history(session_id, "assistant", full_reply)
+        _remember_later(session_id, user_msg, item)
+        timer.mark("store")
+
+    except SlotWaitTimeout:
+        timer.mark("queue")
+        timer.note(outcome="busy")
+        msg = _busy_reply(user_name)
+        append_history(session_id, "assistant", msg)
+        yield timer.sse_comment()
+        yield f"data: {msg}\n\n"
+
+    except DeadlineExceeded:
+        timer.mark("deadline")
+        timer.note(outcome="deadline")
+        fallback("generation")
+        if full_reply:
+            # keep what the user already saw and close it off
+            full_reply += DISCLAIMER
+            yield f"data: {DISCLAIMER}\n\n"
+            append_history(session_id, "assistant", full_reply)
+        else:
+            msg = degraded_reply(
+                user_msg, user_name, meta.get("style", "warm"), "deadline", moderated=True
             )
-            append_history(req.session_id, "assistant", msg)
+            append_history(session_id, "assistant", msg)
+            yield timer.sse_comment()
             yield f"data: {msg}\n\n"
 
-        # Signal end of stream
-        yield "data: [END]\n\n"
+    except Exception:
+        timer.mark("error")
+        timer.note(outcome="error")
+        # We can't distinguish rate limit vs other errors easily here,
+        # so use one gentle fallback.
+        msg = (
+            "I ran into an issue talking to my model just now. "
+            "Can we try again in a bit? 💛"
+        )
+        append_history(session_id, "assistant", msg)
+        yield f"data: {msg}\n\n"
+
+
+@app.get("/sessions/{session_id}/history", response_model=HistoryPage)
+async def session_history(
+    session_id: str,
+    request: Request,
+    response: Response,
+    before: Optional[int] = Query(None, ge=1),
+    limit: int = Query(20, ge=1, le=100),
+):
+    """
+    Restore a conversation, newest page first. Keyset pagination over the
+    message seq: each page is served from the session store and, for older
+    messages it no longer holds, from durable history (HISTORY_PERSIST=1).
+    """
+    items, oldest_held = get_history_page(session_id, before, limit)
+
+    # Older than what the store holds: top up from the DB.
+    durable = HISTORY_PERSIST and (oldest_held is None or oldest_held > 1)
+    if durable and len(items) < limit:
+        if items:
+            upto = items[0]["seq"]
+        elif oldest_held is None or before is None:
+            upto = before if oldest_held is None else oldest_held
+        else:
+            upto = min(before, oldest_held)
+        if upto is None or upto > 1:
+            try:
+                items = await within(get_chat_messages(session_id, upto, limit - len(items))) + items
+            except DeadlineExceeded:
+                # out of time: serve what the store holds, with no cursor past it
+                fallback("history_db")
+                durable = False
+
+    if not items and before is None and get_session_meta(session_id) is None:
+        raise HTTPException(status_code=404, detail="Session not found.")
+
+    first = items[0]["seq"] if items else None
+    has_older = first is not None and first > 1 and (durable or first > oldest_held)
+    next_cursor = first if has_older else None
+
+    # Items never change once written, so the seq range identifies the page.
+    last = items[-1]["seq"] if items else None
+    etag = f'W/"{session_id}:{first}-{last}:{next_cursor}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    return HistoryPage(session_id=session_id, messages=items, next_cursor=next_cursor)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Prometheus scrape endpoint (text exposition format)."""
+    try:
+        stored, active = session_stats(ACTIVE_SESSION_WINDOW_S)
+        SESSIONS_STORED.set(stored)
+        SESSIONS_ACTIVE.set(active)
+    except Exception:
+        pass  # store unreachable: keep the last values, still serve the rest
+    update_mode()
+    return PlainTextResponse(
+        render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+def _require_admin(token: Optional[str]):
+    # 404 rather than 401/403: don't advertise the admin endpoints
+    if not token_ok(token):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@app.get("/admin/profiles")
+def admin_profiles(x_admin_token: Optional[str] = Header(None)):
+    """Recent request profiles (newest first). Needs X-Admin-Token."""
+    _require_admin(x_admin_token)
+    return {"profiles": list_profiles()}
+
+
+@app.get("/admin/profiles/{profile_id}")
+def admin_profile(
+    profile_id: str,
+    format: str = Query("prof", pattern="^(prof|text)$"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """Download a profile as a .prof file, or ?format=text for a summary."""
+    _require_admin(x_admin_token)
+    path = profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found.")
+    if format == "text":
+        return PlainTextResponse(profile_text(path))
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}.prof")
 
 
 @app.get("/health")
 def health():
+    if draining():
+        # not ready: load balancers should stop sending traffic here
+        return JSONResponse(
+            status_code=503,
+            content={"status": "draining", "message": "CompanionBot Plus is shutting down."},
+        )
     return {"status": "ok", "message": "CompanionBot Plus is running."}
 
 
@@ -0,0 +1,178 @@
+# Long-term memory retrieval.
+#
+# After each reply, the exchange ("User: ... / Companion: ...") is added to a
+# per-session index. Before generating, the few snippets most relevant to the
+# new message are retrieved and injected into the prompt under a small token
+# budget, instead of sending more raw history.
+#
+# Vectors are hashed bag-of-words (feature hashing into MEMORY_DIM buckets,
+# sublinear tf, L2-normalised) stored as one contiguous float32 matrix per
+# session. Queries are weighted by idf^2 from the session's own document
+# frequencies, which is equivalent to idf-weighting both sides without
+# re-normalising stored rows. Search is one mat-vec plus argpartition.
+#
+# Memories are keyed by session id. user_external_id is not authenticated,
+# so memories must not follow it across sessions until there is a real user
+# identity. The index is per process.
+
+import os
+import re
+import zlib
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "1") == "1"
+MEMORY_DIM = int(os.getenv("MEMORY_DIM", "256"))
+MEMORY_MAX_PER_SESSION = int(os.getenv("MEMORY_MAX_PER_SESSION", "10000"))
+MEMORY_MAX_SESSIONS = int(os.getenv("MEMORY_MAX_SESSIONS", "1000"))
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "200"))
+# Below this cosine-ish score a snippet is noise, not a memory.
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.15"))
+MEMORY_SNIPPET_CHARS = 400
+# Replies end with the disclaimer footer; it carries nothing worth recalling.
+_FOOTER_MARK = "\n\n(I’m an AI friend"
+
+_TOKEN_RE = re.compile(r"[a-z0-9']{3,}")
+_STOPWORDS = frozenset(
+    """
+    the and for are but not you your yours with this that have has had was were
+    what when where who why how all any can could would should just like really
+    very much about from into than then them they their there these those its
+    i'm it's don't i've i'll you're out get got been being will shall also some
+    """.split()
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _buckets(text: str):
+    counts = {}
+    for word in _TOKEN_RE.findall(text.lower()):
+        if word in _STOPWORDS:
+            continue
+        b = zlib.crc32(word.encode()) % MEMORY_DIM
+        counts[b] = counts.get(b, 0) + 1
+    return counts
+
+
+def vectorize(text: str) -> Optional[np.ndarray]:
+    counts = _buckets(text)
+    if not counts:
+        return None
+    vec = np.zeros(MEMORY_DIM, dtype=np.float32)
+    idx = np.fromiter(counts.keys(), dtype=np.intp, count=len(counts))
+    tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    vec[idx] = 1.0 + np.log(tf)
+    vec /= np.linalg.norm(vec)
+    return vec
+
+
+class SessionMemory:
+    """Ring buffer of snippet vectors for one session."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.vectors = np.zeros((min(64, capacity), MEMORY_DIM), dtype=np.float32)
+        self.texts: List[Optional[str]] = []
+        self.origins: List[tuple] = []  # (session_id, seq) of each snippet
+        self.df = np.zeros(MEMORY_DIM, dtype=np.float32)
+        self.size = 0
+        self._next = 0
+
+    def add(self, vec: np.ndarray, text: str, origin: tuple):
+        if self.size < self.capacity and self.size == len(self.vectors):
+            grown = np.zeros((min(self.capacity, len(self.vectors) * 2), MEMORY_DIM), dtype=np.float32)
+            grown[: self.size] = self.vectors[: self.size]
+            self.vectors = grown
+
+        slot = self._next
+        if self.size == self.capacity:
+            self.df -= self.vectors[slot] > 0  # forget the overwritten snippet
+            self.texts[slot] = text
+            self.origins[slot] = origin
+        else:
+            self.texts.append(text)
+            self.origins.append(origin)
+            self.size += 1
+        self.vectors[slot] = vec
+        self.df += vec > 0
+        self._next = (slot + 1) % self.capacity
+
+    def search(self, query: np.ndarray, k: int, skip=None):
+        """Best (score, text) pairs, best first; `skip(origin)` filters."""
+        if self.size == 0:
+            return []
+        idf = np.log((1.0 + self.size) / (1.0 + self.df)) + 1.0
+        scores = self.vectors[: self.size] @ (query * idf * idf)
+        # normalise so MEMORY_MIN_SCORE means the same at any index size
+        scores /= float(np.linalg.norm(query * idf)) ** 2 or 1.0
+
+        want = min(self.size, k * 2 + 4)  # headroom for skipped snippets
+        top = np.argpartition(-scores, want - 1)[:want]
+        top = top[np.argsort(-scores[top])]
+        out = []
+        for i in top:
+            if scores[i] < MEMORY_MIN_SCORE:
+                break
+            if skip is not None and skip(self.origins[i]):
+                continue
+            out.append((float(scores[i]), self.texts[i]))
+            if len(out) == k:
+                break
+        return out
+
+
+_sessions: "OrderedDict[str, SessionMemory]" = OrderedDict()
+
+
+def _session(key: str, create: bool) -> Optional[SessionMemory]:
+    mem = _sessions.get(key)
+    if mem is None and create:
+        mem = SessionMemory(MEMORY_MAX_PER_SESSION)
+        _sessions[key] = mem
+        while len(_sessions) > MEMORY_MAX_SESSIONS:
+            _sessions.popitem(last=False)
+    if mem is not None:
+        _sessions.move_to_end(key)
+    return mem
+
+
+def remember(key: str, user_message: str, reply: str, session_id: str, seq: int):
+    """Index one exchange. Cheap, but callers run it after the reply is sent."""
+    if not MEMORY_ENABLED:
+        return
+    reply = reply.split(_FOOTER_MARK)[0]
+    text = f"User: {user_message}\nCompanion: {reply}"[:MEMORY_SNIPPET_CHARS]
+    vec = vectorize(user_message + " " + reply)
+    if vec is not None:
+        _session(key, create=True).add(vec, text, (session_id, seq))
+
+
+def recall(key: str, query: str, session_id: str, min_seq: int) -> List[str]:
+    """
+    Snippets relevant to `query` that fit in MEMORY_TOKEN_BUDGET, skipping
+    this session's exchanges from `min_seq` on (already in the prompt).
+    """
+    if not MEMORY_ENABLED:
+        return []
+    mem = _session(key, create=False)
+    vec = vectorize(query)
+    if mem is None or vec is None:
+        return []
+
+    def in_prompt(origin):
+        return origin[0] == session_id and origin[1] >= min_seq
+
+    picked, budget = [], MEMORY_TOKEN_BUDGET
+    for _, text in mem.search(vec, MEMORY_TOP_K, skip=in_prompt):
+        cost = estimate_tokens(text)
+        if cost > budget:
+            continue
+        picked.append(text)
+        budget -= cost
+    return picked
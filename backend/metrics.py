@@ -0,0 +1,202 @@
+# Minimal in-process metrics: counters, gauges and histograms with labels.
+#
+# Metrics are created once at import time by the modules that own them:
+#
+#     BATCH_SIZE = histogram("moderation_batch_size", "Messages per call", buckets=(1, 2, 4, 8))
+#     BATCH_SIZE.observe(3)
+#
+# render_prometheus() returns the Prometheus text format (GET /metrics).
+#
+# Counters and histograms are sharded per thread: each thread only writes
+# its own dict, so recording takes no lock and costs about a microsecond.
+# Readers merge the shards. Gauges are last-write-wins and stay unsharded.
+
+import math
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+# Seconds; suits provider calls and request latency.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: Dict[str, "_Metric"] = {}
+_registry_lock = threading.Lock()
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    if not labels:
+        return ()
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, object] = {}
+
+
+class _Sharded(_Metric):
+    """Keeps one {labels: state} dict per recording thread."""
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append(values)
+            return values
+
+    def _copies(self) -> List[dict]:
+        with self._lock:
+            shards = list(self._shards)
+        # dict() of a dict is a single C call, so it cannot see a half-done write
+        return [dict(shard) for shard in shards]
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        shard = self._shard()
+        shard[key] = shard.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        key = _label_key(labels)
+        return sum(shard.get(key, 0.0) for shard in self._copies())
+
+    def collect(self):
+        out = {}
+        for shard in self._copies():
+            for key, value in shard.items():
+                out[key] = out.get(key, 0.0) + value
+        return out
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[_label_key(labels)] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0.0)
+
+    def collect(self):
+        return dict(self._values)
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        # index of the first bucket with upper bound >= value; len() is +Inf
+        idx = bisect_left(self.buckets, value)
+        shard = self._shard()
+        state = shard.get(key)
+        if state is None:
+            # [per-bucket counts..., +Inf count, sum]
+            state = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[idx] += 1
+        state[-1] += value
+
+    def collect(self):
+        """Return {labels: (cumulative bucket counts, count, sum)}."""
+        merged = {}
+        for shard in self._copies():
+            for key, state in shard.items():
+                state = list(state)
+                total = merged.get(key)
+                merged[key] = state if total is None else [a + b for a, b in zip(total, state)]
+        out = {}
+        for key, state in merged.items():
+            counts = state[:-1]
+            cumulative = []
+            running = 0
+            for c in counts:
+                running += c
+                cumulative.append(running)
+            out[key] = (cumulative, running, state[-1])
+        return out
+
+
+def _get_or_create(cls, name: str, help: str, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = cls(name, help, **kwargs)
+            _registry[name] = metric
+        return metric
+
+
+def counter(name: str, help: str) -> Counter:
+    return _get_or_create(Counter, name, help)
+
+
+def gauge(name: str, help: str) -> Gauge:
+    return _get_or_create(Gauge, name, help)
+
+
+def histogram(name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _get_or_create(Histogram, name, help, buckets=buckets)
+
+
+def _escape(value: str, quotes: bool = True) -> str:
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quotes else value
+
+
+def _labels(key, le: str = None) -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in key]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return repr(value) if math.isfinite(value) else ("+Inf" if value > 0 else "-Inf" if value < 0 else "NaN")
+
+
+def render_prometheus() -> str:
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for name, metric in sorted(_registry.items()):
+        lines.append(f"# HELP {name} {_escape(metric.help, quotes=False)}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for key, value in sorted(metric.collect().items()):
+            if metric.kind != "histogram":
+                lines.append(f"{name}{_labels(key)} {_number(value)}")
+                continue
+            cumulative, count, total = value
+            for bound, c in zip(metric.buckets, cumulative):
+                lines.append(f"{name}_bucket{_labels(key, _number(bound))} {c}")
+            lines.append(f"{name}_bucket{_labels(key, '+Inf')} {count}")
+            lines.append(f"{name}_sum{_labels(key)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(key)} {count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,167 @@
+# Read-through cache in front of the user_profiles table.
+#
+# Returning users hit /start on every session; the profile rarely changes,
+# so it is served from a per-process LRU (and, with REDIS_URL set, a shared
+# Redis tier) for PROFILE_CACHE_TTL_S. A miss costs one get-or-create
+# statement, whose result is cached, so unknown ids never reach the DB twice
+# either. Concurrent misses for the same id share that statement.
+#
+# Profiles are cached as plain dicts:
+#     {"display_name": ..., "companion_name": ..., "preferred_style": ...}
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from db import DATABASE_URL, get_or_create_user_profile
+from metrics import counter, gauge, histogram
+from redis_client import get_redis
+
+PROFILE_CACHE_TTL_S = float(os.getenv("PROFILE_CACHE_TTL_S", "300"))
+PROFILE_CACHE_MAX = int(os.getenv("PROFILE_CACHE_MAX", "10000"))
+PROFILE_CACHE_SHARED = os.getenv("PROFILE_CACHE_SHARED", "1") == "1"
+
+LOOKUPS = counter(
+    "profile_cache_lookups_total",
+    "Profile lookups by result (hit/miss)",
+)
+HIT_RATIO = gauge("profile_cache_hit_ratio", "Share of profile lookups served from cache")
+DB_LATENCY = histogram("profile_db_latency_seconds", "Profile lookups that went to the DB")
+DB_SAVED = counter(
+    "profile_cache_db_seconds_saved_total",
+    "Estimated DB time avoided by cache hits (hits x average DB latency)",
+)
+
+class _ProfileCache:
+    def __init__(self, redis_client):
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()
+        self._redis = redis_client
+        self._inflight = {}
+        self._hits = 0
+        self._lookups = 0
+        self._avg_db_s = 0.0
+
+    @staticmethod
+    def _key(user_external_id: str) -> str:
+        return f"skylar:profile:{user_external_id}"
+
+    def _get_local(self, user_external_id: str):
+        entry = self._local.get(user_external_id)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._local[user_external_id]
+            return None
+        self._local.move_to_end(user_external_id)
+        return value
+
+    def _set_local(self, user_external_id: str, value, ttl: float):
+        self._local[user_external_id] = (value, time.monotonic() + ttl)
+        self._local.move_to_end(user_external_id)
+        while len(self._local) > PROFILE_CACHE_MAX:
+            self._local.popitem(last=False)
+
+    def _get_shared(self, user_external_id: str):
+        if self._redis is None:
+            return None
+        try:
+            raw = self._redis.get(self._key(user_external_id))
+        except Exception:
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    def store(self, user_external_id: str, profile: Optional[dict]):
+        if profile is None:
+            return
+        self._set_local(user_external_id, profile, PROFILE_CACHE_TTL_S)
+        if self._redis is not None:
+            try:
+                self._redis.set(
+                    self._key(user_external_id),
+                    json.dumps(profile),
+                    px=int(PROFILE_CACHE_TTL_S * 1000),
+                )
+            except Exception:
+                pass
+
+    def count(self, result: str):
+        LOOKUPS.inc(result=result)
+        self._lookups += 1
+        if result != "miss":
+            self._hits += 1
+            DB_SAVED.inc(self._avg_db_s)
+        HIT_RATIO.set(self._hits / self._lookups)
+
+    def lookup(self, user_external_id: str):
+        """The cached profile dict, or None if not cached."""
+        value = self._get_local(user_external_id)
+        if value is None:
+            value = self._get_shared(user_external_id)
+            if value is not None:
+                self._set_local(user_external_id, value, PROFILE_CACHE_TTL_S)
+        return value
+
+    async def load(self, user_external_id: str, query) -> Optional[dict]:
+        """
+        Run `query()` (a coroutine factory returning a profile dict or None)
+        against the DB and cache the result. Concurrent loads for the same id
+        share one query.
+        """
+        fut = self._inflight.get(user_external_id)
+        if fut is None:
+            fut = asyncio.ensure_future(self._timed(user_external_id, query))
+            self._inflight[user_external_id] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(user_external_id, None))
+        return await asyncio.shield(fut)
+
+    async def _timed(self, user_external_id: str, query) -> Optional[dict]:
+        started = time.perf_counter()
+        profile = await query()
+        elapsed = time.perf_counter() - started
+        DB_LATENCY.observe(elapsed)
+        # running average used to estimate time saved by hits
+        self._avg_db_s += (elapsed - self._avg_db_s) * 0.1
+        self.store(user_external_id, profile)
+        return profile
+
+
+_cache = _ProfileCache(get_redis() if PROFILE_CACHE_SHARED else None)
+
+
+def cached_profile(user_external_id: str) -> Optional[dict]:
+    """The profile if it is already cached; never touches the DB."""
+    if not DATABASE_URL:
+        return None
+    value = _cache.lookup(user_external_id)
+    if value is not None:
+        _cache.count("hit")
+    return value
+
+
+async def load_or_create_profile(
+    user_external_id: str,
+    display_name: str,
+    companion_name: str,
+    preferred_style: str,
+) -> Optional[dict]:
+    """
+    One get-or-create statement against the DB, result cached. Use after
+    cached_profile() came back empty.
+    """
+    if not DATABASE_URL:
+        return None
+
+    async def query():
+        return await get_or_create_user_profile(
+            user_external_id=user_external_id,
+            display_name=display_name,
+            companion_name=companion_name,
+            preferred_style=preferred_style,
+        )
+
+    _cache.count("miss")
+    return await _cache.load(user_external_id, query)
@@ -1,36 +1,516 @@
-# Simple in-memory session store for development.
-# No Redis required.
+# Session store.
+# In-memory by default for development (no Redis required).
+# Set REDIS_URL to share sessions across workers, or, on a single machine,
+# SESSION_ARENA_PATH (e.g. /dev/shm/skylar-sessions) for a shared-memory
+# arena that all workers map (see _ArenaStore).
+#
+# Every history item gets a per-session sequence number ("seq", starting at
+# 1) and a timestamp ("ts"), so it can be persisted and paged in order.
+#
+# Stores also track each session's last activity, for session_stats().
 
+import fcntl
+import json
+import mmap
+import os
+import struct
 import threading
+import time
+import zlib
+from typing import Optional
 
-_sessions_meta = {}
-_sessions_history = {}
-_lock = threading.Lock()
+from history_writer import enqueue_message
+from metrics import counter
+from tracing import span
 
+REDIS_URL = os.getenv("REDIS_URL")
+# Store calls are synchronous; bound each one so a stuck Redis cannot hold
+# a request (or the event loop) past its deadline.
+REDIS_TIMEOUT_S = float(os.getenv("REDIS_TIMEOUT_MS", "1000")) / 1000.0
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
 
-def save_session_meta(session_id: str, user_name: str, companion_name: str, style: str):
-    with _lock:
-        _sessions_meta[session_id] = {
-            "user_name": user_name,
-            "companion_name": companion_name,
-            "style": style,
-        }
+# keep only last 40 messages per session to avoid unbounded growth
+HISTORY_LIMIT = 40
+
+SESSION_ARENA_PATH = os.getenv("SESSION_ARENA_PATH")
+SESSION_ARENA_SLOTS = int(os.getenv("SESSION_ARENA_SLOTS", "4096"))
+SESSION_ARENA_SLOT_KB = int(os.getenv("SESSION_ARENA_SLOT_KB", "32"))
+
+ARENA_FULL = counter(
+    "session_arena_full_total",
+    "New sessions refused because their arena window had no free slot",
+)
+
+
+class SessionStoreFull(Exception):
+    """The session store has no room for a new session."""
+
+
+class _MemoryStore:
+    shared = False
+
+    def __init__(self):
+        self._meta = {}
+        self._history = {}
+        self._seq = {}
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def save_meta(self, session_id: str, meta: dict):
+        with self._lock:
+            self._meta[session_id] = meta
+            self._active[session_id] = time.time()
+
+    def get_meta(self, session_id: str):
+        with self._lock:
+            return self._meta.get(session_id)
+
+    def append(self, session_id: str, role: str, content: str) -> dict:
+        with self._lock:
+            seq = self._seq.get(session_id, 0) + 1
+            self._seq[session_id] = seq
+            item = {"seq": seq, "role": role, "content": content, "ts": time.time()}
+            self._active[session_id] = item["ts"]
+            history = self._history.setdefault(session_id, [])
+            history.append(item)
+            if len(history) > HISTORY_LIMIT:
+                del history[0 : len(history) - HISTORY_LIMIT]
+            return item
+
+    def history(self, session_id: str):
+        with self._lock:
+            return list(self._history.get(session_id, []))
+
+    def stats(self, active_window_s: float):
+        since = time.time() - active_window_s
+        with self._lock:
+            seen = list(self._active.values())
+        return len(self._meta), sum(1 for ts in seen if ts >= since)
+
+
+# Assign the next seq and push the item in one round trip.
+_APPEND_LUA = """
+local seq = redis.call('INCR', KEYS[2])
+local item = cjson.encode({seq = seq, role = ARGV[1], content = ARGV[2], ts = tonumber(ARGV[3])})
+redis.call('RPUSH', KEYS[1], item)
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[4]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[6])
+return seq
+"""
+
+
+class _RedisStore:
+    shared = True
+
+    def __init__(self, url: str):
+        import redis
+
+        self.client = redis.Redis.from_url(
+            url,
+            decode_responses=True,
+            socket_timeout=REDIS_TIMEOUT_S,
+            socket_connect_timeout=REDIS_TIMEOUT_S,
+        )
+        self._append = self.client.register_script(_APPEND_LUA)
+
+    # session id -> last activity (unix time), for session_stats()
+    _ACTIVE_KEY = "skylar:sessions:active"
+
+    @staticmethod
+    def _key(session_id: str, kind: str) -> str:
+        return f"skylar:session:{session_id}:{kind}"
+
+    def save_meta(self, session_id: str, meta: dict):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self._key(session_id, "meta"), json.dumps(meta), ex=SESSION_TTL_SECONDS)
+        pipe.zadd(self._ACTIVE_KEY, {session_id: time.time()})
+        pipe.execute()
+
+    def get_meta(self, session_id: str):
+        raw = self.client.get(self._key(session_id, "meta"))
+        return json.loads(raw) if raw else None
+
+    def append(self, session_id: str, role: str, content: str) -> dict:
+        ts = time.time()
+        seq = self._append(
+            keys=[
+                self._key(session_id, "history"),
+                self._key(session_id, "seq"),
+                self._ACTIVE_KEY,
+            ],
+            args=[role, content, ts, HISTORY_LIMIT, SESSION_TTL_SECONDS, session_id],
+        )
+        return {"seq": int(seq), "role": role, "content": content, "ts": ts}
+
+    def history(self, session_id: str):
+        raw = self.client.lrange(self._key(session_id, "history"), 0, -1)
+        return [json.loads(item) for item in raw]
+
+    def stats(self, active_window_s: float):
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        # sessions idle past the TTL have expired; drop them from the index
+        pipe.zremrangebyscore(self._ACTIVE_KEY, "-inf", now - SESSION_TTL_SECONDS)
+        pipe.zcard(self._ACTIVE_KEY)
+        pipe.zcount(self._ACTIVE_KEY, now - active_window_s, "+inf")
+        _, total, active = pipe.execute()
+        return total, active
+
+
+class _ArenaStore:
+    """
+    Sessions in one mmap-ed file of fixed-size slots, shared by every worker
+    process that maps it. With the file on tmpfs (/dev/shm) this is shared
+    memory; it is created sparse, so startup costs an open and an mmap and
+    pages are only touched as sessions use them.
+
+    The slot array doubles as the hash index: a session lives in one of the
+    _PROBE slots starting at crc32(session_id) % (slots - _PROBE + 1) (open
+    addressing, no wrap-around). Slots are never emptied, only taken over
+    by a new session once their own has expired, so lookups never need
+    tombstones. A live session is never evicted: when every slot in the
+    window is live, creating a session raises SessionStoreFull.
+
+    A slot holds the session id, last activity, the seq and turn counters,
+    meta as JSON, and history as packed records, oldest first; appending
+    drops the oldest records past HISTORY_LIMIT or the slot's size. Each call
+    takes a POSIX record lock on its window's byte range (shared for reads),
+    plus a process-local lock, since record locks do not exclude threads of
+    the same process.
+
+    Sessions and turn ordering (see turns) are shared; budgets and the other
+    features that use Redis when REDIS_URL is set stay per worker.
+    """
+
+    shared = True
+
+    _MAGIC = b"SKYARENA"
+    _FILE_HEADER = struct.Struct("<8sIII")  # magic, version, slots, slot size
+    _DATA_START = 4096
+    _PROBE = 16
+    _VERSION = 2
+    # sid_len, sid, last active, seq, turn, meta len, history count, history bytes
+    _SLOT_HEADER = struct.Struct("<B63sdQQIHxxI")
+    _META_BYTES = 1024
+    _RECORD = struct.Struct("<QdBI")  # seq, ts, role, content length
+    _ROLES = ("user", "assistant", "system")
+
+    def __init__(self, path: str, slots: int, slot_bytes: int):
+        self.slots = max(slots, self._PROBE)
+        self.slot_bytes = slot_bytes
+        self._history_start = self._SLOT_HEADER.size + self._META_BYTES
+        self._history_bytes = slot_bytes - self._history_start
+        if self._history_bytes < 4096:
+            raise ValueError("SESSION_ARENA_SLOT_KB is too small")
+        size = self._DATA_START + self.slots * slot_bytes
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._DATA_START, 0)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)  # sparse: zero pages on demand
+                os.pwrite(
+                    self._fd,
+                    self._FILE_HEADER.pack(self._MAGIC, self._VERSION, self.slots, slot_bytes),
+                    0,
+                )
+            found = self._FILE_HEADER.unpack(os.pread(self._fd, self._FILE_HEADER.size, 0))
+            if found != (self._MAGIC, self._VERSION, self.slots, slot_bytes):
+                raise RuntimeError(
+                    f"{path} was created by another version or with other "
+                    "SESSION_ARENA_* settings; remove it (all sessions in it "
+                    "are lost) or restore them"
+                )
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._DATA_START, 0)
+        self._mm = mmap.mmap(self._fd, size)
+        self._local = threading.Lock()
+
+    def _window(self, session_id: str) -> int:
+        return zlib.crc32(session_id.encode()) % (self.slots - self._PROBE + 1)
+
+    def _offset(self, slot: int) -> int:
+        return self._DATA_START + slot * self.slot_bytes
+
+    def _lock(self, first: int, mode: int):
+        fcntl.lockf(self._fd, mode, self._PROBE * self.slot_bytes, self._offset(first))
+
+    def _find(self, first: int, sid: bytes):
+        """Offset of the session's slot in its window, or None."""
+        mm = self._mm
+        for slot in range(first, first + self._PROBE):
+            offset = self._offset(slot)
+            sid_len = mm[offset]
+            if sid_len == 0:
+                return None  # slots fill in probe order; nothing further
+            if sid_len == len(sid) and mm[offset + 1 : offset + 1 + sid_len] == sid:
+                return offset
+        return None
+
+    def _claim(self, first: int, sid: bytes) -> int:
+        """The session's slot, taking over a free or expired one if new."""
+        header = self._SLOT_HEADER
+        now = time.time()
+        offset = self._find(first, sid)
+        if offset is not None:
+            if not self._live(offset):
+                # expired: start the session afresh, but keep counting seq so
+                # rows it already persisted are not shadowed by new ones
+                seq, turn = header.unpack_from(self._mm, offset)[3:5]
+                header.pack_into(self._mm, offset, len(sid), sid, now, seq, turn, 0, 0, 0)
+            return offset
+        for slot in range(first, first + self._PROBE):
+            candidate = self._offset(slot)
+            if self._mm[candidate] == 0 or not self._live(candidate):
+                header.pack_into(self._mm, candidate, len(sid), sid, now, 0, 0, 0, 0, 0)
+                return candidate
+        ARENA_FULL.inc()
+        raise SessionStoreFull("no free session slot; raise SESSION_ARENA_SLOTS")
+
+    def _live(self, offset: int) -> bool:
+        return time.time() - self._SLOT_HEADER.unpack_from(self._mm, offset)[2] < SESSION_TTL_SECONDS
+
+    def _locked(self, session_id: str, mode: int, fn):
+        sid = session_id.encode()
+        if len(sid) > 63:
+            if mode == fcntl.LOCK_SH:
+                return None  # could never have been stored
+            raise ValueError("session id too long for the arena")
+        first = self._window(session_id)
+        with self._local:
+            self._lock(first, mode)
+            try:
+                return fn(first, sid)
+            finally:
+                self._lock(first, fcntl.LOCK_UN)
+
+    def save_meta(self, session_id: str, meta: dict):
+        raw = json.dumps(meta).encode()
+        if len(raw) > self._META_BYTES:
+            raise ValueError("session meta too large for the arena slot")
+
+        def write(first, sid):
+            offset = self._claim(first, sid)
+            sid_len, sid_raw, _, seq, turn, _, count, used = self._SLOT_HEADER.unpack_from(
+                self._mm, offset
+            )
+            self._SLOT_HEADER.pack_into(
+                self._mm, offset, sid_len, sid_raw, time.time(), seq, turn, len(raw), count, used
+            )
+            start = offset + self._SLOT_HEADER.size
+            self._mm[start : start + len(raw)] = raw
+
+        self._locked(session_id, fcntl.LOCK_EX, write)
+
+    def get_meta(self, session_id: str):
+        def read(first, sid):
+            offset = self._find(first, sid)
+            if offset is None or not self._live(offset):
+                return None
+            meta_len = self._SLOT_HEADER.unpack_from(self._mm, offset)[5]
+            if not meta_len:
+                return None
+            start = offset + self._SLOT_HEADER.size
+            return json.loads(self._mm[start : start + meta_len])
+
+        return self._locked(session_id, fcntl.LOCK_SH, read)
+
+    def append(self, session_id: str, role: str, content: str) -> dict:
+        body = content.encode()
+        ts = time.time()
+
+        def write(first, sid):
+            mm, record = self._mm, self._RECORD
+            offset = self._claim(first, sid)
+            sid_len, sid_raw, _, seq, turn, meta_len, count, used = self._SLOT_HEADER.unpack_from(
+                mm, offset
+            )
+            seq += 1
+            # replies too big for the whole slot keep their beginning
+            data = body[: self._history_bytes - record.size]
+            need = record.size + len(data)
+
+            # drop the oldest records until the new one fits
+            start = offset + self._history_start
+            drop = 0
+            while count and (count >= HISTORY_LIMIT or used - drop + need > self._history_bytes):
+                drop += record.size + record.unpack_from(mm, start + drop)[3]
+                count -= 1
+            if drop:
+                mm[start : start + used - drop] = mm[start + drop : start + used]
+                used -= drop
+
+            role_code = self._ROLES.index(role) if role in self._ROLES else 0
+            record.pack_into(mm, start + used, seq, ts, role_code, len(data))
+            mm[start + used + record.size : start + used + need] = data
+            self._SLOT_HEADER.pack_into(
+                mm, offset, sid_len, sid_raw, ts, seq, turn, meta_len, count + 1, used + need
+            )
+            return seq
+
+        seq = self._locked(session_id, fcntl.LOCK_EX, write)
+        return {"seq": seq, "role": role, "content": content, "ts": ts}
+
+    def history(self, session_id: str):
+        def read(first, sid):
+            offset = self._find(first, sid)
+            if offset is None or not self._live(offset):
+                return None
+            count, used = self._SLOT_HEADER.unpack_from(self._mm, offset)[6:]
+            start = offset + self._history_start
+            return count, self._mm[start : start + used]
+
+        # copy under the lock, decode after releasing it
+        held = self._locked(session_id, fcntl.LOCK_SH, read)
+        if held is None:
+            return []
+        count, raw = held
+        record = self._RECORD
+        items = []
+        pos = 0
+        for _ in range(count):
+            seq, ts, role_code, length = record.unpack_from(raw, pos)
+            pos += record.size
+            items.append({
+                "seq": seq,
+                "role": self._ROLES[role_code],
+                "content": raw[pos : pos + length].decode(errors="replace"),
+                "ts": ts,
+            })
+            pos += length
+        return items
+
+    def next_turn(self, session_id: str) -> int:
+        """Number the session's next turn (1, 2, ...), across all workers."""
+
+        def write(first, sid):
+            offset = self._claim(first, sid)
+            fields = list(self._SLOT_HEADER.unpack_from(self._mm, offset))
+            fields[4] += 1
+            self._SLOT_HEADER.pack_into(self._mm, offset, *fields)
+            return fields[4]
+
+        return self._locked(session_id, fcntl.LOCK_EX, write)
+
+    def latest_turn(self, session_id: str) -> int:
+        def read(first, sid):
+            offset = self._find(first, sid)
+            return 0 if offset is None else self._SLOT_HEADER.unpack_from(self._mm, offset)[4]
+
+        return self._locked(session_id, fcntl.LOCK_SH, read) or 0
+
+    def stats(self, active_window_s: float):
+        # unlocked scan: a slightly stale count is fine for a gauge
+        now = time.time()
+        total = active = 0
+        for slot in range(self.slots):
+            offset = self._offset(slot)
+            if self._mm[offset] == 0:
+                continue
+            idle = now - struct.unpack_from("<d", self._mm, offset + 64)[0]
+            if idle < SESSION_TTL_SECONDS:
+                total += 1
+                if idle < active_window_s:
+                    active += 1
+        return total, active
+
+
+if REDIS_URL:
+    _store = _RedisStore(REDIS_URL)
+elif SESSION_ARENA_PATH:
+    _store = _ArenaStore(SESSION_ARENA_PATH, SESSION_ARENA_SLOTS, SESSION_ARENA_SLOT_KB * 1024)
+else:
+    _store = _MemoryStore()
+
+
+def is_shared_store() -> bool:
+    """True when sessions are visible to every worker (not process-local)."""
+    return _store.shared
+
+
+def get_redis():
+    """The shared Redis client, or None when running on the in-memory store."""
+    return getattr(_store, "client", None)
+
+
+def get_arena():
+    """The shared-memory arena store, or None unless SESSION_ARENA_PATH is in use."""
+    return _store if isinstance(_store, _ArenaStore) else None
+
+
+_async_redis = None
+
+
+def get_async_redis():
+    """
+    An asyncio client for the same Redis, for code that polls it from the
+    event loop (None without REDIS_URL).
+    """
+    global _async_redis
+    if REDIS_URL and _async_redis is None:
+        import redis.asyncio
+
+        _async_redis = redis.asyncio.Redis.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            socket_timeout=REDIS_TIMEOUT_S,
+            socket_connect_timeout=REDIS_TIMEOUT_S,
+        )
+    return _async_redis
+
+
+def save_session_meta(
+    session_id: str,
+    user_name: str,
+    companion_name: str,
+    style: str,
+    user_external_id: Optional[str] = None,
+):
+    meta = {
+        "user_name": user_name,
+        "companion_name": companion_name,
+        "style": style,
+        "user_external_id": user_external_id,
+    }
+    with span("session_store.save_meta"):
+        _store.save_meta(session_id, meta)
 
 
 def get_session_meta(session_id: str):
-    with _lock:
-        return _sessions_meta.get(session_id)
+    with span("session_store.get_meta"):
+        return _store.get_meta(session_id)
 
 
 def append_history(session_id: str, role: str, content: str):
-    with _lock:
-        history = _sessions_history.setdefault(session_id, [])
-        history.append({"role": role, "content": content})
-        # keep only last 40 messages to avoid unbounded growth
-        if len(history) > 40:
-            del history[0 : len(history) - 40]
+    with span("session_store.append", role=role):
+        item = _store.append(session_id, role, content)
+    enqueue_message(session_id, item)
+    return item
 
 
 def get_history(session_id: str):
-    with _lock:
-        return list(_sessions_history.get(session_id, []))
+    with span("session_store.history"):
+        return _store.history(session_id)
+
+
+def session_stats(active_window_s: float):
+    """(sessions held, sessions active within the last `active_window_s`)."""
+    return _store.stats(active_window_s)
+
+
+def get_history_page(session_id: str, before=None, limit: int = 20):
+    """
+    Up to `limit` items with seq < `before` (latest if None), oldest first,
+    plus the oldest seq the store still holds (None if it holds nothing).
+    Older items than that only exist in durable storage, if anywhere.
+    """
+    items = _store.history(session_id)
+    if not items:
+        return [], None
+    oldest = items[0]["seq"]
+    if before is not None:
+        # seqs are contiguous, so the cut point is plain arithmetic
+        items = items[: max(0, before - oldest)]
+    return items[-limit:], oldest
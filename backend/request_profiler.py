@@ -0,0 +1,139 @@
+# On-demand request profiling.
+#
+# A request is run under cProfile when it carries `X-Profile: <PROFILER_TOKEN>`
+# or is picked by PROFILER_SAMPLE_RATE. The profile covers the request until
+# its response is complete (whole stream included) and is saved as
+# <PROFILER_DIR>/<id>.prof (pstats format; snakeviz / `python -m pstats`
+# read it), with the id returned in an X-Profile-Id header. The newest
+# PROFILER_KEEP profiles are kept; GET /admin/profiles lists them.
+#
+# cProfile sees everything on the event loop thread while it runs, so other
+# requests interleaving with the profiled one show up too, and only one
+# request per process is profiled at a time. With neither PROFILER_TOKEN nor
+# PROFILER_SAMPLE_RATE set, the middleware is not installed at all.
+
+import asyncio
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import random
+import re
+import tempfile
+import time
+import uuid
+
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN", "")
+PROFILER_SAMPLE_RATE = float(os.getenv("PROFILER_SAMPLE_RATE", "0"))
+PROFILER_DIR = os.getenv("PROFILER_DIR", os.path.join(tempfile.gettempdir(), "skylar-profiles"))
+PROFILER_KEEP = int(os.getenv("PROFILER_KEEP", "50"))
+
+PROFILER_ENABLED = bool(PROFILER_TOKEN) or PROFILER_SAMPLE_RATE > 0
+
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def token_ok(token) -> bool:
+    """Constant-time check of a presented admin/profiling token."""
+    return bool(PROFILER_TOKEN) and token is not None and hmac.compare_digest(
+        token.encode(), PROFILER_TOKEN.encode()
+    )
+
+
+def _save(profiler: cProfile.Profile, profile_id: str, meta: dict):
+    os.makedirs(PROFILER_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILER_DIR, f"{profile_id}.prof"))
+    with open(os.path.join(PROFILER_DIR, f"{profile_id}.json"), "w") as f:
+        json.dump(meta, f)
+    for old in list_profiles()[PROFILER_KEEP:]:
+        for ext in (".prof", ".json"):
+            try:
+                os.remove(os.path.join(PROFILER_DIR, old["id"] + ext))
+            except OSError:
+                pass
+
+
+def list_profiles() -> list:
+    """Saved profiles' metadata, newest first."""
+    try:
+        names = os.listdir(PROFILER_DIR)
+    except OSError:
+        return []
+    out = []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(PROFILER_DIR, name)) as f:
+                out.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    out.sort(key=lambda meta: meta["created"], reverse=True)
+    return out
+
+
+def profile_path(profile_id: str):
+    """Path of a saved .prof file, or None if the id is unknown or malformed."""
+    if not _ID_RE.match(profile_id):
+        return None
+    path = os.path.join(PROFILER_DIR, f"{profile_id}.prof")
+    return path if os.path.exists(path) else None
+
+
+def profile_text(path: str, limit: int = 40) -> str:
+    """Top functions by cumulative time, as `python -m pstats` prints them."""
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._busy = False
+
+    def _wanted(self, scope) -> bool:
+        if scope["type"] != "http" or scope["path"].startswith("/admin/"):
+            return False
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                return token_ok(value.decode("latin-1"))
+        return PROFILER_SAMPLE_RATE > 0 and random.random() < PROFILER_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if self._busy or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        self._busy = True
+        profiler = cProfile.Profile()
+        created = time.time()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.disable()
+            self._busy = False
+            meta = {
+                "id": profile_id,
+                "method": scope["method"],
+                "path": scope["path"],
+                "created": created,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            }
+            # response is already complete; keep disk I/O off the loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, _save, profiler, profile_id, meta
+            )
@@ -0,0 +1,189 @@
+# Retries, backoff and a circuit breaker around provider calls.
+#
+#   result = await call_with_retries(lambda: client.aio.models.generate_content(...))
+#
+# Errors are classified as rate_limited (429), server (5xx), timeout, or
+# client/other. The first three are retried with full-jitter exponential
+# backoff while the overall deadline allows; the rest are raised at once.
+#
+# Retryable failures also feed one circuit breaker per provider. After
+# BREAKER_FAILURES consecutive failures it opens and calls fail fast with
+# CircuitOpenError for BREAKER_COOLDOWN_S. Then a single probe call is let
+# through (half-open): success closes the breaker, failure re-opens it.
+#
+# The retry budget is also capped by the request's deadline (see deadline);
+# running out of that raises DeadlineExceeded and does not count against
+# the breaker, since the provider was not at fault.
+
+import asyncio
+import os
+import random
+import time
+
+import httpx
+from google.genai import errors as genai_errors
+
+from deadline import DeadlineExceeded, expired, remaining
+from metrics import counter, gauge
+
+PROVIDER_DEADLINE_S = float(os.getenv("PROVIDER_DEADLINE_S", "30"))
+PROVIDER_ATTEMPT_TIMEOUT_S = float(os.getenv("PROVIDER_ATTEMPT_TIMEOUT_S", "20"))
+PROVIDER_MAX_ATTEMPTS = int(os.getenv("PROVIDER_MAX_ATTEMPTS", "3"))
+RETRY_BASE_S = float(os.getenv("RETRY_BASE_S", "0.2"))
+RETRY_CAP_S = float(os.getenv("RETRY_CAP_S", "2.0"))
+
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN_S", "15"))
+
+RETRYABLE = ("rate_limited", "server", "timeout")
+
+CALL_ERRORS = counter(
+    "llm_errors_total",
+    "Provider call failures by class (rate_limited/server/timeout/client/other)",
+)
+RETRIES = counter("llm_retries_total", "Provider call retries by error class")
+BREAKER_STATE = gauge(
+    "llm_circuit_state",
+    "Circuit breaker state: 0 closed, 1 half-open, 2 open",
+)
+BREAKER_REJECTED = counter(
+    "llm_circuit_rejected_total",
+    "Calls failed fast because the circuit breaker was open",
+)
+
+
+class CircuitOpenError(Exception):
+    """The provider is marked unhealthy; the call was not attempted."""
+
+
+def classify_error(exc: BaseException) -> str:
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(exc, genai_errors.APIError):
+        if exc.code == 429:
+            return "rate_limited"
+        if isinstance(exc, genai_errors.ServerError) or (exc.code or 0) >= 500:
+            return "server"
+        return "client"
+    if isinstance(exc, httpx.TransportError):
+        return "server"
+    return "other"
+
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    _STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failures: int, cooldown_s: float):
+        self.name = name
+        self.failure_threshold = max(1, failures)
+        self.cooldown_s = cooldown_s
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        BREAKER_STATE.set(0, provider=name)
+
+    def _set_state(self, state: str):
+        self.state = state
+        BREAKER_STATE.set(self._STATE_VALUE[state], provider=self.name)
+
+    def is_open(self) -> bool:
+        """True while calls would be rejected (cheap check for callers)."""
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at < self.cooldown_s
+        return self.state == self.HALF_OPEN and self._probing
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpenError or admit the call; True if it is the probe."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.cooldown_s:
+                BREAKER_REJECTED.inc(provider=self.name)
+                raise CircuitOpenError(self.name)
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                BREAKER_REJECTED.inc(provider=self.name)
+                raise CircuitOpenError(self.name)
+            self._probing = True
+            return True
+        return False
+
+    def on_success(self):
+        self._failures = 0
+        self._probing = False
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def on_failure(self):
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self._probing = False
+            self._opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+    def on_abandon(self, probe: bool):
+        """The call was cancelled before it had an outcome."""
+        if probe:
+            self._probing = False
+
+
+breaker = CircuitBreaker("gemini", BREAKER_FAILURES, BREAKER_COOLDOWN_S)
+
+
+def backoff_seconds(attempt: int) -> float:
+    """Full jitter: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(RETRY_CAP_S, RETRY_BASE_S * (2 ** attempt)))
+
+
+async def call_with_retries(
+    call,
+    *,
+    deadline_s: float = PROVIDER_DEADLINE_S,
+    attempt_timeout_s: float = PROVIDER_ATTEMPT_TIMEOUT_S,
+    max_attempts: int = PROVIDER_MAX_ATTEMPTS,
+):
+    """
+    Await `call()` (a zero-argument function returning an awaitable) with
+    retries for transient errors, all within `deadline_s`.
+    """
+    request_left = remaining()
+    if request_left is not None:
+        if request_left <= 0:
+            raise DeadlineExceeded()
+        deadline_s = min(deadline_s, request_left)
+    deadline = time.monotonic() + deadline_s
+    attempt = 0
+    while True:
+        left = deadline - time.monotonic()
+        probe = breaker.before_call()
+        try:
+            result = await asyncio.wait_for(call(), min(attempt_timeout_s, left))
+        except Exception as exc:
+            if expired():
+                # our request ran out of time, not the provider
+                breaker.on_abandon(probe)
+                raise DeadlineExceeded() from exc
+            kind = classify_error(exc)
+            CALL_ERRORS.inc(kind=kind)
+            if kind not in RETRYABLE:
+                # the provider answered (or our own code failed): not an outage
+                if kind == "client":
+                    breaker.on_success()
+                else:
+                    breaker.on_abandon(probe)
+                raise
+            breaker.on_failure()
+
+            attempt += 1
+            delay = backoff_seconds(attempt)
+            if attempt >= max_attempts or time.monotonic() + delay >= deadline:
+                raise
+            RETRIES.inc(kind=kind)
+            await asyncio.sleep(delay)
+        except BaseException:
+            breaker.on_abandon(probe)
+            raise
+        else:
+            breaker.on_success()
+            return result
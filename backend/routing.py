@@ -0,0 +1,97 @@
+# Model routing.
+#
+# Each provider call names a route; the route picks the model:
+#   - "moderation": the safety classifier
+#   - "trivial":    short greetings / acknowledgements ("hi", "ok thanks")
+#   - "chat":       everything else
+#
+# The routing table defaults to a lite model for the first two and the full
+# model for real conversation. Override it with
+#   ROUTE_MODELS="moderation=gemini-2.5-flash-lite,trivial=...,chat=..."
+#
+# Per-route latency and token counts are recorded so the table can be tuned
+# from data. The decision itself is a dict lookup plus a small word check.
+
+import os
+import re
+import time
+from typing import Optional
+
+from metrics import counter, histogram
+from usage_ledger import account
+from tracing import CLIENT, current_span, record_span
+
+MODEL_FULL = os.getenv("MODEL_FULL", "gemini-2.5-flash")
+MODEL_LITE = os.getenv("MODEL_LITE", "gemini-2.5-flash-lite")
+
+ROUTE_MODELS = {
+    "moderation": MODEL_LITE,
+    "trivial": MODEL_LITE,
+    "chat": MODEL_FULL,
+}
+for _rule in filter(None, os.getenv("ROUTE_MODELS", "").split(",")):
+    _route, _, _model = _rule.partition("=")
+    if _route.strip() and _model.strip():
+        ROUTE_MODELS[_route.strip()] = _model.strip()
+
+# A message is "trivial" when it is short and made only of these words.
+TRIVIAL_MAX_WORDS = int(os.getenv("TRIVIAL_MAX_WORDS", "4"))
+TRIVIAL_WORDS = frozenset(
+    """
+    hi hey hello hiya yo heya sup morning evening night afternoon good gm gn
+    ok okay k kk cool nice great sure yes yeah yep yup no nope alright fine
+    thanks thank you thx ty tysm appreciate it lol haha hehe bye goodbye cya
+    see later too same here sounds np
+    """.split()
+)
+_WORD_RE = re.compile(r"[a-z']+")
+
+ROUTE_LATENCY = histogram(
+    "llm_route_latency_seconds",
+    "Provider call latency by route and model",
+)
+ROUTE_TOKENS = counter(
+    "llm_route_tokens_total",
+    "Provider tokens by route, model and kind (prompt/output)",
+)
+ROUTE_CALLS = counter("llm_route_calls_total", "Provider calls by route and model")
+
+
+def route_for_message(text: str) -> str:
+    """Pick "trivial" or "chat" for a user message."""
+    if len(text) > TRIVIAL_MAX_WORDS * 12:
+        return "chat"
+    words = _WORD_RE.findall(text.lower())
+    if 0 < len(words) <= TRIVIAL_MAX_WORDS and all(w in TRIVIAL_WORDS for w in words):
+        return "trivial"
+    return "chat"
+
+
+def model_for(route: str) -> str:
+    return ROUTE_MODELS.get(route, MODEL_FULL)
+
+
+def record(route: str, model: str, seconds: float, usage: Optional[object] = None, owners=None):
+    """
+    Record one provider call; `usage` is a Gemini usage_metadata (or None).
+    It is charged to the current session/user, or split between `owners`
+    (see usage_ledger).
+    """
+    account(route, model, usage, owners)
+    ROUTE_CALLS.inc(route=route, model=model)
+    ROUTE_LATENCY.observe(seconds, route=route, model=model)
+    prompt = output = None
+    if usage is not None:
+        prompt = getattr(usage, "prompt_token_count", None) or 0
+        output = getattr(usage, "candidates_token_count", None) or 0
+        ROUTE_TOKENS.inc(prompt, route=route, model=model, kind="prompt")
+        ROUTE_TOKENS.inc(output, route=route, model=model, kind="output")
+
+    parent = current_span()
+    if parent is not None:
+        now = time.perf_counter()
+        record_span(
+            parent, f"llm.{route}", now - seconds, now, CLIENT,
+            model=model, prompt_tokens=prompt, output_tokens=output,
+            batch_size=len(owners) if owners else None,
+        )
@@ -1,10 +1,15 @@
 from typing import Tuple, Dict
 import os
 import json
+import time
 
 from google import genai
 from google.genai import types
 
+from deadline import MODERATION_DEADLINE_S
+from routing import model_for, record
+from resilience import call_with_retries
+
 # Gemini client – uses GEMINI_API_KEY from env
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
@@ -35,22 +40,25 @@ def crisis_safe_reply(user_name: str, companion_name: str) -> str:
     )
 
 
-def moderate_text(text: str) -> Tuple[bool, Dict]:
-    """
-    Use Gemini as a lightweight moderation classifier.
+MODERATION_CATEGORIES = (
+    "self_harm",
+    "violence",
+    "hate_speech",
+    "sexual_content",
+    "illegal_activities",
+    "other_dangerous_content",
+)
 
-    Returns:
-        (is_flagged, categories_dict)
+# Use JSON mode so the response is machine-parsable
+# (Gemini JSON / structured output feature).
+MODERATION_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    temperature=0.0,
+)
 
-    categories_dict is a simple mapping like:
-    {
-        "self_harm": true/false,
-        "violence": ...,
-        "hate_speech": ...,
-        ...
-    }
-    """
-    prompt = f"""
+
+def moderation_prompt(text: str) -> str:
+    return f"""
 You are a strict safety and content moderation classifier for a mental health
 companion chat app.
 
@@ -74,31 +82,53 @@ Message:
 \"\"\"{text}\"\"\"
 """
 
-    try:
-        # Use JSON mode so the response is machine-parsable
-        # (Gemini JSON / structured output feature). :contentReference[oaicite:0]{index=0}
-        resp = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                response_mime_type="application/json",
-                temperature=0.0,
-            ),
-        )
 
-        raw = resp.text or "{}"
-        data = json.loads(raw)
+def parse_verdict(data) -> Tuple[bool, Dict]:
+    """Turn one {"flagged": ..., "categories": {...}} object into a verdict."""
+    if not isinstance(data, dict):
+        raise ValueError("verdict is not an object")
+
+    flagged = bool(data.get("flagged", False))
+    categories = data.get("categories", {}) or {}
 
-        flagged = bool(data.get("flagged", False))
-        categories = data.get("categories", {}) or {}
+    # Ensure categories is a dict
+    if not isinstance(categories, dict):
+        categories = {}
 
-        # Ensure categories is a dict
-        if not isinstance(categories, dict):
-            categories = {}
+    return flagged, categories
 
-        return flagged, categories
+
+async def amoderate_text(text: str) -> Tuple[bool, Dict]:
+    """
+    Use Gemini as a lightweight moderation classifier.
+
+    Returns:
+        (is_flagged, categories_dict)
+
+    categories_dict is a simple mapping like:
+    {
+        "self_harm": true/false,
+        "violence": ...,
+        "hate_speech": ...,
+        ...
+    }
+    """
+    model = model_for("moderation")
+    try:
+        started = time.perf_counter()
+        resp = await call_with_retries(
+            lambda: client.aio.models.generate_content(
+                model=model,
+                contents=moderation_prompt(text),
+                config=MODERATION_CONFIG,
+            ),
+            deadline_s=MODERATION_DEADLINE_S,
+            attempt_timeout_s=MODERATION_DEADLINE_S,
+        )
+        record("moderation", model, time.perf_counter() - started, resp.usage_metadata)
+        return parse_verdict(json.loads(resp.text or "{}"))
 
     except Exception:
         # If moderation is unavailable, fail soft:
-        # rely on crisis keywords + Gemini's own built-in safety for generation. :contentReference[oaicite:1]{index=1}
+        # rely on crisis keywords + Gemini's own built-in safety for generation.
         return False, {}
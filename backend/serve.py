@@ -0,0 +1,91 @@
+# Production launcher.
+#
+#     python serve.py
+#
+# Runs main:app under uvicorn without the dev-only reload, with:
+#   - WEB_CONCURRENCY workers ("auto", the default: one per CPU this process
+#     may run on). More than one worker needs a session store all workers
+#     share (REDIS_URL, or SESSION_ARENA_PATH on a single machine): with the
+#     in-memory store sessions would land on whichever worker took the
+#     request, so an explicit count > 1 is refused and "auto" falls back to
+#     a single worker.
+#   - uvloop and httptools when installed (pip install uvloop httptools),
+#     else asyncio and h11.
+#   - keep-alive longer than typical load balancer idle timeouts (so the LB,
+#     not us, closes idle connections and never reuses one we just closed),
+#     and a larger accept backlog for connection bursts.
+#   - no access log by default (every request already lands in /metrics).
+
+import importlib.util
+import os
+import sys
+
+import uvicorn
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY", "auto")
+KEEPALIVE_S = int(os.getenv("KEEPALIVE_S", "75"))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+# after the app's own drain (drain.py), for idle connections to close
+GRACEFUL_TIMEOUT_S = int(os.getenv("GRACEFUL_TIMEOUT_S", "10"))
+ACCESS_LOG = os.getenv("ACCESS_LOG", "0") == "1"
+
+
+def _cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        return os.cpu_count() or 1
+
+
+def _installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def worker_count(shared_store: bool) -> int:
+    if WEB_CONCURRENCY == "auto":
+        if not shared_store:
+            return 1
+        return _cpus()
+    workers = max(1, int(WEB_CONCURRENCY))
+    if workers > 1 and not shared_store:
+        raise SystemExit(
+            f"WEB_CONCURRENCY={workers} needs a shared session store: with the "
+            "in-memory store each worker only sees its own sessions. Set "
+            "REDIS_URL or SESSION_ARENA_PATH, or run one worker."
+        )
+    return workers
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    from redis_client import is_shared_store
+
+    workers = worker_count(is_shared_store())
+    loop = "uvloop" if _installed("uvloop") else "asyncio"
+    http = "httptools" if _installed("httptools") else "h11"
+    print(
+        f"serve: {workers} worker(s), loop={loop}, http={http}, "
+        f"shared_store={is_shared_store()}, cpus={_cpus()}",
+        file=sys.stderr,
+    )
+    uvicorn.run(
+        "main:app",
+        app_dir=here,
+        host=HOST,
+        port=PORT,
+        workers=workers,
+        loop=loop,
+        http=http,
+        backlog=BACKLOG,
+        timeout_keep_alive=KEEPALIVE_S,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT_S,
+        access_log=ACCESS_LOG,
+        proxy_headers=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Per-request stage timing.
+#
+# A StageTimer is created at the top of a request and `mark(name)` is called
+# as each stage finishes; the time since the previous mark is charged to that
+# stage. The breakdown is reported four ways:
+#
+#   - a Server-Timing header (visible in browser dev tools),
+#   - for streams, an SSE comment line before the first token (headers are
+#     already gone by then), e.g. ": server-timing moderation;dur=212.4, ...",
+#   - a structured JSON log line on the "skylar.timing" logger, for a
+#     STAGE_LOG_SAMPLE_RATE fraction of requests plus every request slower
+#     than STAGE_LOG_SLOW_MS,
+#   - when the request is traced, one "stage.<name>" span per stage
+#     (with any events recorded during it, e.g. stream chunks).
+
+import os
+import random
+import time
+
+from logs import get_logger, log_event
+from tracing import MAX_EVENTS_PER_SPAN, current_span, record_span
+
+STAGE_LOG_SAMPLE_RATE = float(os.getenv("STAGE_LOG_SAMPLE_RATE", "0.01"))
+STAGE_LOG_SLOW_MS = float(os.getenv("STAGE_LOG_SLOW_MS", "3000"))
+
+logger = get_logger("timing")
+
+
+class StageTimer:
+    __slots__ = ("route", "started", "stages", "fields", "_last", "_trace", "_events")
+
+    def __init__(self, route: str):
+        self.route = route
+        self.started = self._last = time.perf_counter()
+        self.stages = []  # [(name, seconds)] in order; names may repeat
+        self.fields = {}  # extra context for the log line
+        self._trace = current_span()  # None unless this request is traced
+        self._events = None
+
+    def mark(self, name: str) -> float:
+        """Close the stage `name` (everything since the previous mark)."""
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self.stages.append((name, elapsed))
+        if self._trace is not None:
+            record_span(self._trace, f"stage.{name}", self._last, now, events=self._events)
+            self._events = None
+        self._last = now
+        return elapsed
+
+    def event(self, name: str, **attrs):
+        """Trace event inside the current stage (dropped when not traced)."""
+        if self._trace is not None:
+            if self._events is None:
+                self._events = []
+            if len(self._events) < MAX_EVENTS_PER_SPAN:
+                self._events.append((time.time_ns(), name, attrs))
+
+    def note(self, **fields):
+        """Attach context (outcome, model, ...) to the log line."""
+        self.fields.update(fields)
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: one entry per stage, plus the total."""
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages]
+        parts.append(f"total;dur={self.total() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def sse_comment(self) -> str:
+        return f": server-timing {self.server_timing()}\n\n"
+
+    def log(self):
+        """Write the breakdown if this request is sampled or slow."""
+        total_ms = self.total() * 1000
+        if total_ms < STAGE_LOG_SLOW_MS and random.random() >= STAGE_LOG_SAMPLE_RATE:
+            return
+        stages = {}
+        for name, seconds in self.stages:
+            stages[name] = round(stages.get(name, 0.0) + seconds * 1000, 2)
+        log_event(
+            logger,
+            "request_timing",
+            route=self.route,
+            total_ms=round(total_ms, 2),
+            stages_ms=stages,
+            **self.fields,
+        )
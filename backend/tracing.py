@@ -0,0 +1,317 @@
+# Lightweight in-process tracing.
+#
+# With TRACE_SAMPLE_RATE > 0, TracingMiddleware opens a root span for a
+# sampled share of HTTP requests (or any request whose W3C `traceparent`
+# header says sampled) and puts it in a context variable. Code underneath
+# opens child spans with
+#
+#     with span("session_store.get_meta"):
+#         ...
+#
+# which returns a shared no-op object when the request is not traced, so
+# instrumentation costs one ContextVar lookup. StageTimer stages become
+# spans automatically and provider calls are recorded by routing.record().
+#
+# Finished spans are copied into a preallocated ring buffer (the oldest are
+# overwritten, and counted, if the exporter falls behind). Every
+# TRACE_EXPORT_INTERVAL_S they are appended to TRACE_EXPORT_PATH as one
+# OTLP/JSON ExportTraceServiceRequest per line, which the OpenTelemetry
+# Collector's otlpjsonfile receiver (or any OTLP JSON reader) can ingest.
+
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from metrics import counter
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_BUFFER_SPANS = int(os.getenv("TRACE_BUFFER_SPANS", "8192"))
+TRACE_EXPORT_INTERVAL_S = float(os.getenv("TRACE_EXPORT_INTERVAL_S", "5"))
+TRACE_EXPORT_PATH = os.getenv(
+    "TRACE_EXPORT_PATH", os.path.join(tempfile.gettempdir(), "skylar-traces.jsonl")
+)
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "skylar-backend")
+
+TRACING_ENABLED = TRACE_SAMPLE_RATE > 0
+
+# OTLP SpanKind
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+MAX_EVENTS_PER_SPAN = 256
+
+EXPORTED = counter("trace_spans_exported_total", "Spans written to TRACE_EXPORT_PATH")
+DROPPED = counter("trace_spans_dropped_total", "Spans overwritten before they were exported")
+
+# perf_counter -> unix time, for spans recorded after the fact
+_EPOCH_OFFSET_NS = time.time_ns() - time.perf_counter_ns()
+
+_current: ContextVar[Optional["Span"]] = ContextVar("trace_span", default=None)
+
+
+class _RingBuffer:
+    """Fixed slots of [trace, span, parent, name, kind, start, end, attrs, events, error]."""
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._slots = [[None] * 10 for _ in range(self.capacity)]
+        self._head = 0  # spans written, ever
+        self._tail = 0  # spans exported (or dropped), ever
+        self._lock = threading.Lock()
+
+    def put(self, *fields):
+        with self._lock:
+            self._slots[self._head % self.capacity][:] = fields
+            self._head += 1
+
+    def drain(self) -> list:
+        with self._lock:
+            lost = self._head - self._tail - self.capacity
+            if lost > 0:
+                DROPPED.inc(lost)
+                self._tail += lost
+            out = [list(self._slots[i % self.capacity]) for i in range(self._tail, self._head)]
+            self._tail = self._head
+        return out
+
+
+_buffer = _RingBuffer(TRACE_BUFFER_SPANS)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns",
+                 "attrs", "events", "error", "_token", "_ended")
+
+    def __init__(self, trace_id: int, parent_id: int, name: str, kind: int, attrs: dict):
+        self.trace_id = trace_id
+        self.span_id = random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.attrs = attrs
+        self.events = None
+        self.error = None
+        self._token = None
+        self._ended = False
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and self.error is None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.end()
+        _current.reset(self._token)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add_event(self, name: str, **attrs):
+        if self.events is None:
+            self.events = []
+        if len(self.events) < MAX_EVENTS_PER_SPAN:
+            self.events.append((time.time_ns(), name, attrs))
+
+    def end(self):
+        if not self._ended:
+            self._ended = True
+            _buffer.put(self.trace_id, self.span_id, self.parent_id, self.name, self.kind,
+                        self.start_ns, time.time_ns(), self.attrs, self.events, self.error)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+    def add_event(self, name: str, **attrs):
+        pass
+
+    def end(self):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def span(name: str, kind: int = INTERNAL, **attrs):
+    """Child span of the current one; a no-op when the request is not traced."""
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return Span(parent.trace_id, parent.span_id, name, kind, attrs)
+
+
+def record_span(parent: Span, name: str, start_perf: float, end_perf: float,
+                kind: int = INTERNAL, events=None, **attrs):
+    """Record a finished span from perf_counter() timestamps, under `parent`."""
+    _buffer.put(
+        parent.trace_id, random.getrandbits(64), parent.span_id, name, kind,
+        _EPOCH_OFFSET_NS + int(start_perf * 1e9), _EPOCH_OFFSET_NS + int(end_perf * 1e9),
+        attrs, events, None,
+    )
+
+
+def _parse_traceparent(value: str):
+    """(trace_id, parent_span_id, sampled) from a W3C traceparent, or None."""
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        return int(parts[1], 16), int(parts[2], 16), int(parts[3], 16) & 1 == 1
+    except ValueError:
+        return None
+
+
+class TracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        upstream = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                upstream = _parse_traceparent(value.decode("latin-1"))
+                break
+        if upstream is not None:
+            trace_id, parent_id, sampled = upstream
+        else:
+            trace_id, parent_id = random.getrandbits(128), 0
+            sampled = random.random() < TRACE_SAMPLE_RATE
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+
+        root = Span(trace_id, parent_id, f'{scope["method"]} {scope["path"]}', SERVER,
+                    {"http.method": scope["method"], "http.target": scope["path"]})
+        trace_hex = f"{trace_id:032x}"
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.attrs["http.status_code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-trace-id", trace_hex.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        with root:
+            await self.app(scope, receive, send_wrapper)
+            route = scope.get("route")
+            if route is not None:
+                root.name = f'{scope["method"]} {route.path}'
+                root.attrs["http.route"] = route.path
+
+
+def _value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _attributes(attrs: dict) -> list:
+    return [{"key": k, "value": _value(v)} for k, v in attrs.items() if v is not None]
+
+
+def _otlp_span(fields) -> dict:
+    trace_id, span_id, parent_id, name, kind, start_ns, end_ns, attrs, events, error = fields
+    out = {
+        "traceId": f"{trace_id:032x}",
+        "spanId": f"{span_id:016x}",
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": _attributes(attrs or {}),
+        "status": {"code": 2, "message": error} if error else {},
+    }
+    if parent_id:
+        out["parentSpanId"] = f"{parent_id:016x}"
+    if events:
+        out["events"] = [
+            {"timeUnixNano": str(ts), "name": ev_name, "attributes": _attributes(ev_attrs)}
+            for ts, ev_name, ev_attrs in events
+        ]
+    return out
+
+
+def _write(spans: list):
+    request = {
+        "resourceSpans": [{
+            "resource": {"attributes": _attributes({"service.name": TRACE_SERVICE_NAME})},
+            "scopeSpans": [{"scope": {"name": "skylar"}, "spans": [_otlp_span(s) for s in spans]}],
+        }]
+    }
+    with open(TRACE_EXPORT_PATH, "a") as f:
+        f.write(json.dumps(request, separators=(",", ":")) + "\n")
+    EXPORTED.inc(len(spans))
+
+
+class _Exporter:
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.export()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL_S)
+            try:
+                await self.export()
+            except OSError:
+                pass  # unwritable path; spans of this interval are lost
+
+    async def export(self):
+        spans = _buffer.drain()
+        if spans:
+            await asyncio.get_running_loop().run_in_executor(None, _write, spans)
+
+
+_exporter = _Exporter()
+
+
+def start_trace_exporter():
+    if TRACING_ENABLED:
+        _exporter.start()
+
+
+async def stop_trace_exporter():
+    if TRACING_ENABLED:
+        await _exporter.stop()
@@ -0,0 +1,338 @@
+# Per-session turn scheduling.
+#
+# Only one generation runs per session at a time, so history is always
+# "user, assistant, user, assistant" and every prompt sees a consistent
+# conversation. A newer message either queues behind the active turn
+# (TURN_POLICY=queue) or makes the active stream stop at its next chunk
+# (TURN_POLICY=supersede).
+#
+# With the in-memory store this is a per-session asyncio.Lock. With REDIS_URL
+# set it is a leased Redis lock plus a FIFO ticket queue, so it also holds
+# across workers; a background task renews the lease for as long as the turn
+# is held, however long the queue or provider takes. With the shared-memory
+# arena (SESSION_ARENA_PATH) it is a POSIX record lock on a side file, which
+# the kernel drops by itself if a worker dies.
+#
+# The wait is also cut short by the request's deadline (see deadline).
+
+import asyncio
+import fcntl
+import os
+import time
+import uuid
+import zlib
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from deadline import budget
+from redis_client import SESSION_ARENA_PATH, get_arena, get_async_redis
+
+TURN_POLICY = os.getenv("TURN_POLICY", "queue").lower()
+if TURN_POLICY not in ("queue", "supersede"):
+    TURN_POLICY = "queue"
+
+# How long a turn may wait for the one in front of it.
+TURN_WAIT_TIMEOUT_S = float(os.getenv("TURN_WAIT_TIMEOUT_S", "60"))
+# Redis lock lease; renewed in the background for as long as the turn is held.
+TURN_LEASE_MS = int(os.getenv("TURN_LEASE_MS", "30000"))
+# How often a Redis- or arena-backed turn re-checks whether it was superseded.
+_SUPERSEDE_CHECK_S = 0.25
+
+
+class TurnWaitTimeout(Exception):
+    """The previous turn in this session did not finish in time."""
+
+
+class Turn:
+    def __init__(self, scheduler, session_id: str, number: int):
+        self._scheduler = scheduler
+        self.session_id = session_id
+        self.number = number
+        self.latest_seen = number  # newest turn number seen (shared schedulers)
+        self._superseded = False
+
+    def superseded(self) -> bool:
+        """True once a newer message has arrived and the policy is 'supersede'."""
+        if not self._superseded and TURN_POLICY == "supersede":
+            self._superseded = self._scheduler.latest(self) != self.number
+        return self._superseded
+
+
+class _LocalTurns:
+    shared = False
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._latest: Dict[str, int] = {}
+        self._refs: Dict[str, int] = {}
+
+    async def acquire(self, session_id: str) -> Turn:
+        number = self._latest.get(session_id, 0) + 1
+        self._latest[session_id] = number
+        self._refs[session_id] = self._refs.get(session_id, 0) + 1
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        try:
+            await asyncio.wait_for(lock.acquire(), max(0.0, budget(TURN_WAIT_TIMEOUT_S)))
+        except asyncio.TimeoutError:
+            self._unref(session_id)
+            raise TurnWaitTimeout(session_id)
+        except BaseException:
+            self._unref(session_id)
+            raise
+        return Turn(self, session_id, number)
+
+    def release(self, turn: Turn):
+        self._locks[turn.session_id].release()
+        self._unref(turn.session_id)
+
+    def _unref(self, session_id: str):
+        self._refs[session_id] -= 1
+        if self._refs[session_id] == 0:
+            # nobody active or waiting: drop per-session state
+            del self._refs[session_id]
+            del self._locks[session_id]
+            del self._latest[session_id]
+
+    def latest(self, turn: Turn) -> int:
+        return self._latest.get(turn.session_id, 0)
+
+    async def hold(self, turn: Turn):
+        pass  # nothing to renew in-process
+
+
+# Queue the ticket (again, if it was dropped as stale) and note that its
+# waiter is alive, then take the lock only if it is free and this ticket is at
+# the head of the queue. One script, so no other worker ever sees the ticket
+# queued without a "last seen" time.
+_ACQUIRE_LUA = """
+local now = redis.call('TIME')
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[2], now[1] * 1000 + math.floor(now[2] / 1000))
+redis.call('PEXPIRE', KEYS[2], ARGV[4])
+redis.call('PEXPIRE', KEYS[3], ARGV[4])
+local head = redis.call('ZRANGE', KEYS[2], 0, 0)
+if head[1] ~= ARGV[2] then return 0 end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[3]) then
+  redis.call('ZREM', KEYS[2], ARGV[2])
+  redis.call('HDEL', KEYS[3], ARGV[2])
+  return 1
+end
+return 0
+"""
+
+# Drop the head ticket if its waiter has not polled for ARGV[2] ms (and so has
+# also been queued at least that long): its worker died while queued.
+_DROP_STALE_LUA = """
+local head = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+if head == nil or head == ARGV[1] then return 0 end
+local now = redis.call('TIME')
+local seen = tonumber(redis.call('HGET', KEYS[2], head) or 0)
+if now[1] * 1000 + math.floor(now[2] / 1000) - seen < tonumber(ARGV[2]) then
+  return 0
+end
+redis.call('ZREM', KEYS[1], head)
+redis.call('HDEL', KEYS[2], head)
+return 1
+"""
+
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_REFRESH_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class _RedisTurns:
+    shared = True
+    # A queued turn whose waiter stops polling for this long is treated as gone.
+    _WAITER_TTL_MS = 5000
+
+    def __init__(self, client):
+        # an asyncio client: every call here is made from the event loop
+        self.r = client
+        self._acquire = client.register_script(_ACQUIRE_LUA)
+        self._release = client.register_script(_RELEASE_LUA)
+        self._refresh = client.register_script(_REFRESH_LUA)
+        self._drop_stale = client.register_script(_DROP_STALE_LUA)
+        self._owner = uuid.uuid4().hex
+        self._releases = set()
+
+    @staticmethod
+    def _key(session_id: str, kind: str) -> str:
+        return f"skylar:turn:{session_id}:{kind}"
+
+    def _token(self, turn: Turn) -> str:
+        return f"{self._owner}:{turn.number}"
+
+    async def acquire(self, session_id: str) -> Turn:
+        lock_key = self._key(session_id, "lock")
+        queue_key = self._key(session_id, "queue")
+        seen_key = self._key(session_id, "seen")
+        latest_key = self._key(session_id, "latest")
+
+        number = await self.r.incr(latest_key)
+        await self.r.pexpire(latest_key, TURN_LEASE_MS * 4)
+        ticket = str(number)
+        turn = Turn(self, session_id, number)
+
+        deadline = time.monotonic() + budget(TURN_WAIT_TIMEOUT_S)
+        delay = 0.01
+        try:
+            while True:
+                if await self._acquire(
+                    keys=[lock_key, queue_key, seen_key],
+                    args=[self._token(turn), ticket, TURN_LEASE_MS, TURN_LEASE_MS * 4],
+                ):
+                    return turn
+                await self._drop_stale(
+                    keys=[queue_key, seen_key], args=[ticket, self._WAITER_TTL_MS]
+                )
+                if time.monotonic() > deadline:
+                    raise TurnWaitTimeout(session_id)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.2)
+        except BaseException:
+            # also on cancellation, so don't wait for Redis here
+            self._later(self.r.zrem(queue_key, ticket))
+            self._later(self.r.hdel(seen_key, ticket))
+            raise
+
+    def _later(self, coro):
+        # release runs from finally blocks, including a closing stream
+        # generator that can no longer await
+        task = asyncio.ensure_future(coro)
+        self._releases.add(task)
+        task.add_done_callback(self._releases.discard)
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def release(self, turn: Turn):
+        self._later(
+            self._release(keys=[self._key(turn.session_id, "lock")], args=[self._token(turn)])
+        )
+
+    def latest(self, turn: Turn) -> int:
+        return turn.latest_seen  # kept fresh by hold()
+
+    async def hold(self, turn: Turn):
+        """Renew the lease (and watch for newer turns) until cancelled."""
+        lock_key = self._key(turn.session_id, "lock")
+        latest_key = self._key(turn.session_id, "latest")
+        renew_every = TURN_LEASE_MS / 3000.0
+        interval = min(renew_every, _SUPERSEDE_CHECK_S) if TURN_POLICY == "supersede" else renew_every
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if time.monotonic() - renewed >= renew_every:
+                    await self._refresh(keys=[lock_key], args=[self._token(turn), TURN_LEASE_MS])
+                    renewed = time.monotonic()
+                if TURN_POLICY == "supersede":
+                    turn.latest_seen = int(await self.r.get(latest_key) or 0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass  # Redis blip: try again next round, the lease has slack
+
+
+class _ArenaTurns:
+    """
+    Turns shared by the workers of one machine through the session arena.
+
+    Inside a worker, turns of a session queue on _LocalTurns. The one at the
+    head then takes an exclusive record lock on one byte of `lock_path`, at
+    offset crc32(session_id), which keeps other workers out. Two sessions
+    whose ids collide share that byte: they only serialize across workers,
+    and a worker holding it for one lets its own turns of the other through.
+    Across workers the lock is polled, so a turn there is not queued in
+    arrival order. Turn numbers live in the session's arena slot.
+    """
+
+    shared = True
+
+    def __init__(self, arena, lock_path: str):
+        self._arena = arena
+        self._fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._local = _LocalTurns()
+        self._held: Dict[int, int] = {}  # lock byte -> turns of this worker on it
+        self._inner: Dict[Turn, Turn] = {}
+
+    async def acquire(self, session_id: str) -> Turn:
+        deadline = time.monotonic() + budget(TURN_WAIT_TIMEOUT_S)
+        number = self._arena.next_turn(session_id)
+        inner = await self._local.acquire(session_id)
+        try:
+            await self._lock(zlib.crc32(session_id.encode()), deadline, session_id)
+        except BaseException:
+            self._local.release(inner)
+            raise
+        turn = Turn(self, session_id, number)
+        self._inner[turn] = inner
+        return turn
+
+    async def _lock(self, byte: int, deadline: float, session_id: str):
+        if not self._held.get(byte):
+            delay = 0.005
+            while True:
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, byte)
+                    break
+                except OSError:
+                    pass  # another worker holds it
+                if time.monotonic() > deadline:
+                    raise TurnWaitTimeout(session_id)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.1)
+        self._held[byte] = self._held.get(byte, 0) + 1
+
+    def release(self, turn: Turn):
+        byte = zlib.crc32(turn.session_id.encode())
+        self._held[byte] -= 1
+        if self._held[byte] == 0:
+            del self._held[byte]
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, byte)
+        self._local.release(self._inner.pop(turn))
+
+    def latest(self, turn: Turn) -> int:
+        return turn.latest_seen  # kept fresh by hold()
+
+    async def hold(self, turn: Turn):
+        """Watch for newer turns until cancelled; the lock needs no renewal."""
+        if TURN_POLICY != "supersede":
+            return
+        while True:
+            await asyncio.sleep(_SUPERSEDE_CHECK_S)
+            turn.latest_seen = self._arena.latest_turn(turn.session_id)
+
+
+_redis = get_async_redis()
+if _redis is not None:
+    _scheduler = _RedisTurns(_redis)
+elif get_arena() is not None:
+    _scheduler = _ArenaTurns(get_arena(), SESSION_ARENA_PATH + ".turns")
+else:
+    _scheduler = _LocalTurns()
+
+
+@asynccontextmanager
+async def session_turn(session_id: str):
+    """
+    Hold the session's turn for the duration of the block.
+
+    Raises TurnWaitTimeout if the previous turn does not finish within
+    TURN_WAIT_TIMEOUT_S.
+    """
+    turn = await _scheduler.acquire(session_id)
+    keeper = asyncio.ensure_future(_scheduler.hold(turn))
+    try:
+        yield turn
+    finally:
+        keeper.cancel()
+        _scheduler.release(turn)
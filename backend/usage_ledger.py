@@ -0,0 +1,260 @@
+# Token usage and cost accounting.
+#
+# Every provider call goes through routing.record(), which hands its
+# usage_metadata to account() here. Usage (prompt / cached / output tokens
+# and estimated cost) is aggregated in memory per session, user, route and
+# model, and flushed every USAGE_FLUSH_INTERVAL_S: into the usage_daily
+# table when DATABASE_URL is set, else as a "usage_flush" log line.
+#
+# The session/user a call is charged to comes from a context variable set
+# at the start of each chat turn (set_owner), so it follows the request into
+# tasks it spawns. Batched moderation passes its callers explicitly and the
+# batch's usage is split evenly between them.
+#
+# USER_DAILY_TOKEN_BUDGET caps tokens per user per UTC day, where the "user"
+# is main's _user_key (for now the session, as user_external_id is not
+# authenticated). over_budget() is a dict lookup; with REDIS_URL set the
+# per-user totals are shared through Redis at each flush, so all workers see
+# each other's spend (up to one flush interval late).
+
+import asyncio
+import logging
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+from db import DATABASE_URL, add_usage_daily
+from logs import get_logger, log_event
+from metrics import counter
+from redis_client import get_redis
+
+USAGE_FLUSH_INTERVAL_S = float(os.getenv("USAGE_FLUSH_INTERVAL_S", "60"))
+USER_DAILY_TOKEN_BUDGET = int(os.getenv("USER_DAILY_TOKEN_BUDGET", "0"))  # 0 = unlimited
+
+# USD per 1M tokens: (input, cached input, output). Estimates for reporting;
+# override with MODEL_PRICES="model=input:cached:output,...".
+MODEL_PRICES = {
+    "gemini-2.5-pro": (1.25, 0.31, 10.0),
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.025, 0.40),
+}
+for _item in filter(None, os.getenv("MODEL_PRICES", "").split(",")):
+    _model, _, _prices = _item.partition("=")
+    MODEL_PRICES[_model.strip()] = tuple(float(p) for p in _prices.split(":"))
+
+COST = counter("llm_cost_usd_total", "Estimated provider cost (USD) by route and model")
+OVER_BUDGET = counter("usage_budget_rejections_total", "Turns refused because the user's daily budget was spent")
+
+logger = get_logger("usage")
+
+# (session_id, user_key) the current request's provider calls are charged to
+_owner: ContextVar[Optional[Tuple[str, str]]] = ContextVar("usage_owner", default=None)
+
+
+def set_owner(session_id: str, user_key: str):
+    _owner.set((session_id, user_key))
+
+
+def current_owner() -> Optional[Tuple[str, str]]:
+    return _owner.get()
+
+
+@contextmanager
+def charged_to(owner: Optional[Tuple[str, str]]):
+    token = _owner.set(owner)
+    try:
+        yield
+    finally:
+        _owner.reset(token)
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def _tokens(usage) -> Tuple[int, int, int]:
+    """(prompt, cached, output) from a usage_metadata; thinking counts as output."""
+    if usage is None:
+        return 0, 0, 0
+    prompt = getattr(usage, "prompt_token_count", None) or 0
+    cached = getattr(usage, "cached_content_token_count", None) or 0
+    output = (getattr(usage, "candidates_token_count", None) or 0) + (
+        getattr(usage, "thoughts_token_count", None) or 0
+    )
+    return prompt, cached, output
+
+
+def cost_usd(model: str, prompt: int, cached: int, output: int) -> float:
+    input_price, cached_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0, 0.0))
+    return (
+        (prompt - cached) * input_price + cached * cached_price + output * output_price
+    ) / 1_000_000
+
+
+class UsageLedger:
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._day = _today()
+        # (day, scope, key) -> [calls, prompt, cached, output, cost] since last flush
+        self._pending = {}
+        # per-user tokens today: as of the last flush (all workers when shared),
+        # and spent in this process since then
+        self._flushed = {}
+        self._unflushed = {}
+        self._task = None
+
+    def _roll(self):
+        today = _today()
+        if today != self._day:
+            self._day = today
+            self._flushed = {}
+            self._unflushed = {}
+
+    def _add(self, scope: str, key: str, share: float, prompt, cached, output, cost):
+        row = self._pending.get((self._day, scope, key))
+        if row is None:
+            row = self._pending[(self._day, scope, key)] = [0.0, 0.0, 0.0, 0.0, 0.0]
+        row[0] += share
+        row[1] += prompt * share
+        row[2] += cached * share
+        row[3] += output * share
+        row[4] += cost * share
+
+    def account(self, route: str, model: str, usage, owners=None):
+        self._roll()
+        prompt, cached, output = _tokens(usage)
+        cost = cost_usd(model, prompt, cached, output)
+        if cost:
+            COST.inc(cost, route=route, model=model)
+        self._add("route", route, 1.0, prompt, cached, output, cost)
+        self._add("model", model, 1.0, prompt, cached, output, cost)
+
+        owners = [o for o in (owners or [current_owner()]) if o is not None]
+        for session_id, user_key in owners:
+            share = 1.0 / len(owners)
+            self._add("session", session_id, share, prompt, cached, output, cost)
+            self._add("user", user_key, share, prompt, cached, output, cost)
+            self._unflushed[user_key] = (
+                self._unflushed.get(user_key, 0.0) + (prompt + output) * share
+            )
+
+    def spent_today(self, user_key: str) -> float:
+        self._roll()
+        return self._flushed.get(user_key, 0.0) + self._unflushed.get(user_key, 0.0)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as exc:
+            # last chance: put the rows in the log rather than lose them
+            log_event(
+                logger,
+                "usage_flush_failed",
+                logging.ERROR,
+                error=repr(exc),
+                rows=_records(self._pending),
+            )
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL_S)
+            try:
+                await self.flush()
+            except Exception:
+                pass  # rows were put back; try again next interval
+
+    def _share_budgets(self, unflushed: dict):
+        """Push this worker's spend to Redis and pull everyone's totals."""
+        if self._redis is None:
+            for user_key, tokens in unflushed.items():
+                self._flushed[user_key] = self._flushed.get(user_key, 0.0) + tokens
+            return
+        users = list(set(self._flushed) | set(unflushed))
+        pipe = self._redis.pipeline(transaction=False)
+        for user_key in users:
+            key = f"skylar:usage:{self._day}:{user_key}"
+            pipe.incrbyfloat(key, unflushed.get(user_key, 0.0))
+            pipe.expire(key, 2 * 24 * 3600)
+        totals = pipe.execute()[::2]
+        self._flushed.update((u, float(t)) for u, t in zip(users, totals))
+
+    async def flush(self):
+        self._roll()
+        rows, self._pending = self._pending, {}
+        unflushed, self._unflushed = self._unflushed, {}
+        try:
+            self._share_budgets(unflushed)
+        except Exception:
+            # Redis unavailable: keep counting locally
+            for user_key, tokens in unflushed.items():
+                self._flushed[user_key] = self._flushed.get(user_key, 0.0) + tokens
+        if not rows:
+            return
+
+        records = _records(rows)
+        if not DATABASE_URL:
+            log_event(logger, "usage_flush", rows=records)
+            return
+        try:
+            await add_usage_daily(records)
+        except Exception:
+            for key, row in rows.items():
+                pending = self._pending.setdefault(key, [0.0] * 5)
+                for i, value in enumerate(row):
+                    pending[i] += value
+            raise
+
+
+def _records(rows: dict) -> list:
+    return [
+        {
+            "day": day,
+            "scope": scope,
+            "key": key,
+            "calls": calls,
+            "prompt_tokens": prompt,
+            "cached_tokens": cached,
+            "output_tokens": output,
+            "cost_usd": cost,
+        }
+        for (day, scope, key), (calls, prompt, cached, output, cost) in rows.items()
+    ]
+
+
+_ledger = UsageLedger(get_redis())
+
+
+def account(route: str, model: str, usage, owners=None):
+    """Charge one provider call to the current owner (or to `owners`, split)."""
+    _ledger.account(route, model, usage, owners)
+
+
+def over_budget(user_key: str) -> bool:
+    """True once the user has used USER_DAILY_TOKEN_BUDGET tokens today."""
+    if USER_DAILY_TOKEN_BUDGET <= 0:
+        return False
+    if _ledger.spent_today(user_key) < USER_DAILY_TOKEN_BUDGET:
+        return False
+    OVER_BUDGET.inc()
+    return True
+
+
+def start_usage_flusher():
+    _ledger.start()
+
+
+async def stop_usage_flusher():
+    await _ledger.stop()